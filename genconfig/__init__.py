@@ -38,4 +38,5 @@ from genconfig.producers import *
 from genconfig.sinks import *
 from genconfig.base import *
 from genconfig.utils import *
+from genconfig.aio import *
 
@@ -0,0 +1,527 @@
+"""asyncio flavour of the pipe-like infix syntax:
+AsyncProducers, AsyncFilters and AsyncSinks follow the same protocols as their
+synchronous counterparts, but are driven by an event loop, so I/O-bound sources
+can overlap. Use async_producer, async_filter, async_sink and sync_producer to
+mix them with ordinary pipe objects."""
+
+__license__ = """
+## License ##    
+# Copyright (C) 2011 Mika Pflüger <mika@mikapflueger.de>
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at
+# your option) any later version.                                      
+#                                                                      
+# This program is distributed in the hope that it will be useful, but  
+# WITHOUT ANY WARRANTY to the extent permittet by applicable law; without
+# even the implied warranty of           
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU    
+# General Public License for more details. (See COPYING)               
+#                                                                      
+# You should have received a copy of the GNU General Public License    
+# along with this program.  If not, see <http://www.gnu.org/licenses/> 
+#
+# This product includes software developed by the OpenSSL Project
+# for use in the OpenSSL Toolkit. (http://www.openssl.org/)
+#
+# * In addition, as a special exception, the copyright holders give
+# * permission to link the code of portions of this program with the
+# * OpenSSL library under certain conditions as described in each
+# * individual source file, and distribute linked combinations
+# * including the two.
+# * You must obey the GNU General Public License in all respects
+# * for all of the code used other than OpenSSL.  If you modify
+# * file(s) with this exception, you may extend this exception to your
+# * version of the file(s), but you are not obligated to do so.  If you
+# * do not wish to do so, delete this exception statement from your
+# * version.  If you delete this exception statement from all source
+# * files in the program, then also delete it here.
+##"""
+
+import asyncio
+import collections
+import concurrent.futures
+
+from . import base
+
+class AsyncProducer(base.Pipe):
+    """Base class for Producers which are driven by an asyncio event loop.
+    The protocol is the same as for Producer, only asynchronous:
+    async with AsyncProducer() as prod:
+        async for chunk in prod:
+            # whatever
+    AsyncProducer.next_batch(size) is a coroutine returning a non-empty list
+    of chunks or raising StopAsyncIteration.
+
+    Piping an AsyncProducer into a Sink (async or not) gives a coroutine which
+    evaluates to the result of the Sink, so a pipe is run with
+    result = await (AsyncProducer() | Filter() | Sink())
+    Filters and Sinks which are not async are adapted, they are run in the
+    event loop thread.
+    """
+    def __init__(self):
+        base.Pipe.__init__(self)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, type_=None, value=None, traceback=None):
+        pass
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        raise StopAsyncIteration
+
+    async def next_batch(self, size=None):
+        if size is None:
+            size = base.BATCH_SIZE
+        output = []
+        try:
+            while len(output) < size:
+                output.append(await self.__anext__())
+        except StopAsyncIteration:
+            if not output:
+                raise
+        return output
+
+    def __or__(self, other):
+        if isinstance(other, base.RawFilter):
+            return AsyncFilteredProducer(self, async_filter(other))
+        elif isinstance(other, base.Sink):
+            return async_sink(other).__ror__(self)
+        return other.__ror__(self)
+
+
+class AsyncIteratorProducer(AsyncProducer):
+    """Make an AsyncProducer from an asynchronous iterator."""
+    def __init__(self, iterator):
+        AsyncProducer.__init__(self)
+        self._iterator = iterator.__aiter__()
+
+    async def __anext__(self):
+        return await self._iterator.__anext__()
+
+    def __str__(self):
+        return "AsyncIteratorProducer(%s)" % str(self._iterator)
+
+
+class AsyncFilter(base.Pipe):
+    """Base class for Filters which are driven by an asyncio event loop.
+    The protocol is the same as for RawFilter, but send, last and __anext__
+    are coroutines, and __anext__ raises StopAsyncIteration instead of
+    StopIteration when the Filter is exhausted (NeedData stays the same)."""
+    def __init__(self):
+        base.Pipe.__init__(self)
+        self._last = False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, type_=None, value=None, traceback=None):
+        pass
+
+    async def last(self):
+        self._last = True
+
+    async def send(self, chunk):
+        pass
+
+    async def __anext__(self):
+        raise StopAsyncIteration
+
+    def __or__(self, other):
+        if isinstance(other, base.RawFilter):
+            return AsyncCombinedFilter(self, async_filter(other))
+        elif isinstance(other, base.Sink):
+            return AsyncFilteredSink(self, async_sink(other))
+        return other.__ror__(self)
+
+    def __ror__(self, other):
+        if isinstance(other, AsyncFilter):
+            return AsyncCombinedFilter(other, self)
+        elif isinstance(other, base.RawFilter):
+            return AsyncCombinedFilter(async_filter(other), self)
+        return AsyncFilteredProducer(_async_source(other), self)
+
+
+class AsyncCombinedFilter(AsyncFilter):
+    def __init__(self, source, target):
+        AsyncFilter.__init__(self)
+        self._source = source
+        self._target = target
+        self._source_exhausted = False
+
+    def __str__(self):
+        return ' | '.join((str(self._source), str(self._target)))
+
+    async def send(self, chunk):
+        await self._source.send(chunk)
+
+    async def last(self):
+        await self._source.last()
+
+    async def __anext__(self):
+        # see CombinedFilter: a NeedData from the source and a
+        # StopAsyncIteration from the target are propagated to the caller
+        while True:
+            try:
+                return await self._target.__anext__()
+            except base.NeedData:
+                pass
+            if not self._source_exhausted:
+                try:
+                    await self._target.send(await self._source.__anext__())
+                except StopAsyncIteration:
+                    await self._target.last()
+                    self._source_exhausted = True
+
+    async def __aenter__(self):
+        self._source = await self._source.__aenter__()
+        self._target = await self._target.__aenter__()
+        return self
+
+    async def __aexit__(self, type_=None, value=None, traceback=None):
+        await self._source.__aexit__()
+        await self._target.__aexit__()
+
+
+class AsyncFilteredProducer(AsyncProducer):
+    """Combination of an AsyncProducer and an AsyncFilter."""
+    def __init__(self, producer, filter_):
+        AsyncProducer.__init__(self)
+        self._producer = producer
+        self._filter = filter_
+        self._producer_exhausted = False
+
+    async def __aenter__(self):
+        self._producer = await self._producer.__aenter__()
+        self._filter = await self._filter.__aenter__()
+        return self
+
+    async def __aexit__(self, type_=None, value=None, traceback=None):
+        await self._producer.__aexit__()
+        await self._filter.__aexit__()
+
+    async def __anext__(self):
+        while True:
+            try:
+                return await self._filter.__anext__()
+            except base.NeedData:
+                if self._producer_exhausted:
+                    raise StopAsyncIteration
+            try:
+                await self._filter.send(await self._producer.__anext__())
+            except StopAsyncIteration:
+                self._producer_exhausted = True
+                await self._filter.last()
+
+    def __str__(self):
+        return " | ".join((str(self._producer), str(self._filter)))
+
+
+class AsyncSink(base.Pipe):
+    """Base class for Sinks which are driven by an asyncio event loop.
+    When subclassing, overwrite the send coroutine and the result function.
+    To stop pulling, send raises StopAsyncIteration.
+    Piping a source into an AsyncSink gives a coroutine evaluating to the
+    result, sources which are not async are adapted with async_producer."""
+    def __init__(self):
+        base.Pipe.__init__(self)
+
+    async def _pull(self, source):
+        async with source:
+            while True:
+                try:
+                    chunks = await source.next_batch()
+                except StopAsyncIteration:
+                    break
+                try:
+                    await self.send_batch(chunks)
+                except StopAsyncIteration:
+                    break
+        return self.result()
+
+    def result(self):
+        return None
+
+    def __ror__(self, source):
+        if isinstance(source, (AsyncFilter, base.RawFilter)):
+            return AsyncFilteredSink(source, self)
+        return self._pull(_async_source(source))
+
+    async def send(self, chunk):
+        raise StopAsyncIteration
+
+    async def send_batch(self, chunks):
+        for chunk in chunks:
+            await self.send(chunk)
+
+
+class AsyncFilteredSink(AsyncSink):
+    def __init__(self, filter_, sink):
+        AsyncSink.__init__(self)
+        if not isinstance(filter_, AsyncFilter):
+            filter_ = async_filter(filter_)
+        self._filter = filter_
+        self._sink = sink
+
+    async def _pull(self, source):
+        return await self._sink._pull(AsyncFilteredProducer(source, self._filter))
+
+    def __str__(self):
+        return '( %s | %s )' % (str(self._filter), repr(self._sink))
+
+
+class async_producer(AsyncProducer):
+    """Adapts a Producer (or any iterable) to the AsyncProducer protocol.
+    If threaded is True, the Producer is run in a thread of its own, so a
+    blocking Producer (think of a database query) doesn't stall the event
+    loop. Otherwise it is run in the event loop thread."""
+    def __init__(self, producer, threaded=True):
+        AsyncProducer.__init__(self)
+        if not isinstance(producer, base.Producer):
+            producer = base.IteratorProducer(producer)
+        self._producer = producer
+        self._threaded = threaded
+        self._batch = collections.deque()
+
+    async def _call(self, function, *args):
+        if self._executor is None:
+            return function(*args)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, function, *args)
+
+    def _next_batch(self, size):
+        # StopIteration can't be passed through a Future
+        try:
+            return self._producer.next_batch(size)
+        except StopIteration:
+            return None
+
+    async def __aenter__(self):
+        if self._threaded:
+            # one thread, as some Producers have to stay in the thread they
+            # were created in
+            self._executor = concurrent.futures.ThreadPoolExecutor(1)
+        else:
+            self._executor = None
+        self._producer = await self._call(self._producer.__enter__)
+        return self
+
+    async def __aexit__(self, type_=None, value=None, traceback=None):
+        await self._call(self._producer.__exit__)
+        if self._executor is not None:
+            self._executor.shutdown()
+
+    async def next_batch(self, size=None):
+        if self._batch:
+            output = list(self._batch)
+            self._batch.clear()
+            return output
+        output = await self._call(self._next_batch, size)
+        if output is None:
+            raise StopAsyncIteration
+        return output
+
+    async def __anext__(self):
+        if not self._batch:
+            self._batch.extend(await self.next_batch())
+        return self._batch.popleft()
+
+    def __str__(self):
+        return 'async_producer(%s)' % str(self._producer)
+
+
+class async_filter(AsyncFilter):
+    """Adapts a Filter to the AsyncFilter protocol. The Filter is run in the
+    event loop thread, so it shouldn't block."""
+    def __init__(self, filter_):
+        AsyncFilter.__init__(self)
+        self._filter = filter_
+
+    async def __aenter__(self):
+        self._filter = self._filter.__enter__()
+        return self
+
+    async def __aexit__(self, type_=None, value=None, traceback=None):
+        self._filter.__exit__()
+
+    async def last(self):
+        self._filter.last()
+
+    async def send(self, chunk):
+        self._filter.send(chunk)
+
+    async def __anext__(self):
+        # a StopIteration must not escape from a coroutine
+        try:
+            return next(self._filter)
+        except StopIteration:
+            raise StopAsyncIteration
+
+    def __str__(self):
+        return 'async_filter(%s)' % str(self._filter)
+
+
+class async_sink(AsyncSink):
+    """Adapts a Sink to the AsyncSink protocol. The Sink is run in the
+    event loop thread, so it shouldn't block."""
+    def __init__(self, sink):
+        AsyncSink.__init__(self)
+        self._sink = sink
+
+    def result(self):
+        return self._sink.result()
+
+    async def send(self, chunk):
+        try:
+            self._sink.send(chunk)
+        except StopIteration:
+            raise StopAsyncIteration
+
+    async def send_batch(self, chunks):
+        try:
+            self._sink.send_batch(chunks)
+        except StopIteration:
+            raise StopAsyncIteration
+
+    def __repr__(self):
+        return 'async_sink(%s)' % repr(self._sink)
+
+
+class sync_producer(base.Producer):
+    """Adapts an AsyncProducer to the Producer protocol, so it can be used in
+    ordinary pipes. The AsyncProducer is run in an event loop of its own,
+    so this can't be used from within a running event loop."""
+    def __init__(self, producer):
+        base.Producer.__init__(self)
+        self._producer = producer
+
+    def __enter__(self):
+        self._loop = asyncio.new_event_loop()
+        self._producer = self._loop.run_until_complete(self._producer.__aenter__())
+        return self
+
+    def __exit__(self, type_=None, value=None, traceback=None):
+        try:
+            self._loop.run_until_complete(self._producer.__aexit__())
+        finally:
+            self._loop.close()
+
+    def __next__(self):
+        try:
+            return self._loop.run_until_complete(self._producer.__anext__())
+        except StopAsyncIteration:
+            raise StopIteration
+
+    def next_batch(self, size=None):
+        try:
+            return self._loop.run_until_complete(self._producer.next_batch(size))
+        except StopAsyncIteration:
+            raise StopIteration
+
+    def __str__(self):
+        return 'sync_producer(%s)' % str(self._producer)
+
+
+def _async_source(source):
+    if isinstance(source, AsyncProducer):
+        return source
+    elif hasattr(source, '__aiter__'):
+        return AsyncIteratorProducer(source)
+    elif isinstance(source, base.Producer):
+        return async_producer(source)
+    return async_producer(source, threaded=False)
+
+
+class interleave(AsyncProducer):
+    """Runs several sources concurrently and yields their chunks in the order
+    they arrive. Sources can be AsyncProducers, async iterables, Producers
+    (which are run in threads of their own) or iterables.
+    At most queue_size batches are buffered."""
+    def __init__(self, *sources, queue_size=16):
+        AsyncProducer.__init__(self)
+        self._sources = [_async_source(source) for source in sources]
+        self._queue_size = queue_size
+        self._batch = collections.deque()
+
+    async def _run_source(self, source):
+        try:
+            async with source:
+                while True:
+                    try:
+                        chunks = await source.next_batch()
+                    except StopAsyncIteration:
+                        break
+                    await self._queue.put((chunks, None))
+        except Exception as error:
+            await self._queue.put((None, error))
+        else:
+            await self._queue.put((None, None))
+
+    async def __aenter__(self):
+        self._queue = asyncio.Queue(self._queue_size)
+        self._running = len(self._sources)
+        self._tasks = [asyncio.ensure_future(self._run_source(source))
+                       for source in self._sources]
+        return self
+
+    async def __aexit__(self, type_=None, value=None, traceback=None):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def next_batch(self, size=None):
+        if self._batch:
+            output = list(self._batch)
+            self._batch.clear()
+            return output
+        while self._running:
+            chunks, error = await self._queue.get()
+            if error is not None:
+                raise error
+            if chunks is None:
+                self._running -= 1
+            else:
+                return chunks
+        raise StopAsyncIteration
+
+    async def __anext__(self):
+        if not self._batch:
+            self._batch.extend(await self.next_batch())
+        return self._batch.popleft()
+
+    def __str__(self):
+        return 'interleave(%s)' % ', '.join(str(source) for source in self._sources)
+
+
+class async_apply(AsyncFilter):
+    """Awaits function(chunk) for every chunk piped to it, for up to
+    concurrency chunks at the same time. The output keeps the order of
+    the input."""
+    def __init__(self, function, concurrency=1):
+        AsyncFilter.__init__(self)
+        self._function = function
+        self._concurrency = concurrency
+        self._futures = collections.deque()
+
+    async def __aexit__(self, type_=None, value=None, traceback=None):
+        for future in self._futures:
+            future.cancel()
+        await asyncio.gather(*self._futures, return_exceptions=True)
+
+    async def send(self, chunk):
+        self._futures.append(asyncio.ensure_future(self._function(chunk)))
+
+    async def __anext__(self):
+        futures = self._futures
+        if futures and (self._last or len(futures) >= self._concurrency or futures[0].done()):
+            return await futures.popleft()
+        if self._last:
+            raise StopAsyncIteration
+        raise base.NeedData
+
+    def __str__(self):
+        return 'async_apply(%s)' % str(self._function)
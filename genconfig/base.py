@@ -35,11 +35,21 @@ __license__ = """
 ##"""
 
 import os
+import stat
 import shutil
-import subprocess
 import types
 import copy
 import fcntl
+import collections
+import collections.abc
+import concurrent.futures
+import hashlib
+import locale
+import codecs
+import itertools
+
+# Number of chunks pulled at once when pipes are driven via the batch protocol
+BATCH_SIZE = 1024
 
 class NeedData(Exception):
     def __str__(self):
@@ -118,6 +128,19 @@ class RawFilter(Pipe, EasyWriteMixIn):
     no longer interested in output from the Filter, you have to call Filter.__exit__()
     for any cleanup to happen.
 
+    Additionally, Filters follow a batch protocol, which moves many chunks per call
+    and is used by Sinks pulling from a pipe:
+    * call Filter.send_batch(chunks) instead of Filter.send(chunk) to provide a list
+      of chunks of input at once.
+    * call Filter.next_batch() instead of Filter.next() to obtain a non-empty list of
+      chunks of output. It raises NeedData and StopIteration just like Filter.next().
+    After Filter.send_batch(chunks), you have to obtain output via Filter.next_batch()
+    until it raises NeedData, only then you may provide more input or call
+    Filter.last().
+    The RawFilter implementation of the batch protocol falls back to the one-chunk
+    protocol, so you only need to overwrite send_batch and next_batch if your Filter
+    can handle many chunks at once more efficiently.
+
     This Base class RawFilter should only be subclassed by Filters which need full control over
     the protocol. For common cases see the Filter class (functions operating on one
     chunk of data at a time, yielding one chunk of output for every input) and the
@@ -131,6 +154,8 @@ class RawFilter(Pipe, EasyWriteMixIn):
     def __init__(self):
         Pipe.__init__(self)
         self._last = False
+        self._pending = collections.deque()
+        self._exhausted = False
 
     def __enter__(self):
         return self
@@ -147,9 +172,42 @@ class RawFilter(Pipe, EasyWriteMixIn):
     def __next__(self):
         raise StopIteration
 
+    def send_batch(self, chunks):
+        self._pending.extend(chunks)
+
+    def next_batch(self):
+        # Feed pending chunks one at a time and collect everything the
+        # one-chunk protocol yields in between.
+        if self._exhausted:
+            raise StopIteration
+        output = []
+        while True:
+            try:
+                output.append(next(self))
+            except NeedData:
+                if self._pending:
+                    self.send(self._pending.popleft())
+                elif output:
+                    return output
+                else:
+                    raise
+            except StopIteration:
+                self._exhausted = True
+                if output:
+                    return output
+                raise
+
+    def _absorb(self, following):
+        """Called when the Filter following is piped after this one. Return a
+        single Filter doing the work of both to replace them, or None."""
+        return None
+
     def __ror__(self, other):
         if isinstance(other, RawFilter):
             return CombinedFilter(other, self)
+        elif isinstance(other, FilteredProducer):
+            # Keep the pipe flat: one Producer and the combined Filters
+            return FilteredProducer(other._producer, CombinedFilter(other._filter, self))
         elif isinstance(other, Producer):
             return FilteredProducer(other, self)
         else:
@@ -169,6 +227,14 @@ class Filter(RawFilter):
     exceptions as needed, you don't have to worry about them.
     If you want to, you can provide your own __enter__() and/or
     __exit__() functions, but you must not overwrite last().
+
+    If the output of your Filter only depends on one chunk of input at a time
+    (yielding one or no chunk of output for it), overwrite _process_chunk(chunk)
+    instead of next(). It is given the chunk and returns the output chunk or
+    raises NeedData to drop the chunk. Such Filters get a native implementation
+    of the batch protocol, which you can speed up further by overwriting
+    _process_batch(chunks), returning the list of output chunks for a list of
+    input chunks.
     """
     def __init__(self):
         RawFilter.__init__(self)
@@ -191,65 +257,156 @@ class Filter(RawFilter):
 
     _chunk = property(_get_chunk, _set_chunk)
 
+    def _process_chunk(self, chunk):
+        return chunk
+
+    def _process_batch(self, chunks):
+        process = self._process_chunk
+        output = []
+        for chunk in chunks:
+            try:
+                output.append(process(chunk))
+            except NeedData:
+                pass
+        return output
+
     def __next__(self):
-        return self._chunk
+        return self._process_chunk(self._chunk)
     
     def send(self, chunk):
         self._chunk = chunk
 
+    def next_batch(self):
+        if type(self).__next__ is not Filter.__next__:
+            # next() is overwritten, so we can't rely on _process_chunk
+            return RawFilter.next_batch(self)
+        chunks = list(self._pending)
+        self._pending.clear()
+        if self._input_avail:
+            chunks.insert(0, self._chunk)
+        if chunks:
+            output = self._process_batch(chunks)
+            if output:
+                return output
+        if self._last:
+            raise StopIteration
+        raise NeedData
+
 class CombinedFilter(RawFilter):
-    def __init__(self, source, target):
+    """Combination of Filters is a Filter again.
+    The combined Filters are kept as a flat list of stages, which is
+    driven by a single loop: output of a stage is sent to the following
+    stage, a NeedData moves on to the preceding stage and a StopIteration
+    notifies the following stage via last(). So the cost per chunk does
+    not grow with the nesting of the pipe.
+    """
+    def __init__(self, *stages):
         RawFilter.__init__(self)
-        self._source = source
-        self._target = target
-        self._source_exhausted = False
+        self._stages = []
+        for stage in stages:
+            if isinstance(stage, CombinedFilter):
+                self._add_stages(stage._stages)
+            else:
+                self._add_stages([stage])
+        # All stages before this one are exhausted
+        self._live = 0
+        # The stage to resume with: after returning output, this is the
+        # last stage, after raising NeedData, the stages after the first
+        # are still waiting for data, so we resume with the first one.
+        self._resume = len(self._stages) - 1
+
+    def _add_stages(self, stages):
+        for stage in stages:
+            if self._stages:
+                absorbed = self._stages[-1]._absorb(stage)
+                if absorbed is not None:
+                    self._stages[-1] = absorbed
+                    continue
+            self._stages.append(stage)
 
     def __str__(self):
-        return ' | '.join((str(_self.source), str(self._target)))
+        return ' | '.join([str(stage) for stage in self._stages])
 
     def send(self, chunk):
-        self._source.send(chunk)
+        self._stages[0].send(chunk)
+
+    def send_batch(self, chunks):
+        self._stages[0].send_batch(chunks)
 
     def last(self):
-        self._source.last()
+        self._stages[0].last()
 
     def __next__(self):
-        # Try if we can get a value from the target
-        # without providing more info
-        # A StopIteration from the target will be propagated
-        try:
-            return next(self._target)
-        except NeedData:
-            pass
-        # Target needs data - will pull chunks from the source
-        # and send them to the target until the target returns
-        # something or the source is exhausted.
-        # A StopIteration from the source means we need to notify
-        # the target about last(), a StopIteration from the target
-        # will simply be propagated to the caller
+        stages = self._stages
+        top = len(stages) - 1
+        i = self._resume
+        self._resume = top
         while True:
-            if not self._source_exhausted:
-                try:
-                    self._target.send(next(self._source))
-                    # The maybe raised NeedData will just be propagated
-                    # to the caller, which is fine -- we are in a need
-                    # of data then.
-                except StopIteration:
-                    self._target.last()
-                    self._source_exhausted = True
             try:
-                return next(self._target)
+                chunk = next(stages[i])
             except NeedData:
+                # unless the stage stopped in next_batch() already
+                if not stages[i]._exhausted:
+                    if i > self._live:
+                        i -= 1
+                        continue
+                    if i == 0:
+                        # we are in a need of data from the caller
+                        self._resume = 0
+                        raise
+                # the stage won't get any more data, it is exhausted
+            except StopIteration:
+                pass
+            else:
+                if i == top:
+                    return chunk
+                stages[i + 1].send(chunk)
+                i += 1
+                continue
+            # stage i is exhausted, so the following stage gets no more input
+            if i == top:
+                raise StopIteration
+            stages[i + 1].last()
+            self._live = i + 1
+            i += 1
+
+    def next_batch(self):
+        # Same as next(), but moving lists of chunks
+        stages = self._stages
+        top = len(stages) - 1
+        i = self._resume
+        self._resume = top
+        while True:
+            try:
+                chunks = stages[i].next_batch()
+            except NeedData:
+                if i > self._live:
+                    i -= 1
+                    continue
+                if i == 0:
+                    self._resume = 0
+                    raise
+            except StopIteration:
                 pass
+            else:
+                if i == top:
+                    return chunks
+                stages[i + 1].send_batch(chunks)
+                i += 1
+                continue
+            if i == top:
+                raise StopIteration
+            stages[i + 1].last()
+            self._live = i + 1
+            i += 1
 
     def __enter__(self):
-        self._source = self._source.__enter__()
-        self._target = self._target.__enter__()
+        self._stages = [stage.__enter__() for stage in self._stages]
         return self
 
     def __exit__(self, type_=None, value=None, traceback=None):
-        self._source.__exit__()
-        self._target.__exit__()
+        for stage in self._stages:
+            stage.__exit__()
 
 class combine(object):
     """Combine two Filters."""
@@ -267,7 +424,7 @@ class FilterNeedsAll(RawFilter):
     function, which will be given a list of all input.
     It must return an iterable of output.
     You can provide your own __enter__() and/or __exit__() functions, but you
-    must not overwrite last(), send(chunk) or next().
+    must not overwrite last(), send(chunk), next() or their batch counterparts.
     """
     def __init__(self):
         RawFilter.__init__(self)
@@ -286,6 +443,20 @@ class FilterNeedsAll(RawFilter):
     def send(self, chunk):
         self._input.append(chunk)
 
+    def send_batch(self, chunks):
+        self._input.extend(chunks)
+
+    def next_batch(self):
+        if not self._last:
+            raise NeedData
+        if not self._processed:
+            self._output = iter(self._process(self._input))
+            self._processed = True
+        output = list(itertools.islice(self._output, BATCH_SIZE))
+        if not output:
+            raise StopIteration
+        return output
+
 
 class Producer(Pipe, EasyWriteMixIn):
     """Producer base class.
@@ -300,8 +471,13 @@ class Producer(Pipe, EasyWriteMixIn):
         for i in prod:
             # whatever
 
+    Instead of Producer.next(), you can also call Producer.next_batch(size), which
+    returns a non-empty list of (about, size is a hint) size chunks or raises
+    StopIteration if the Producer is exhausted.
+
     When subclassing, you should provide a useful next() function and
-    can overwrite the __enter__() and/or __exit__() functions.
+    can overwrite the __enter__() and/or __exit__() functions. If your Producer
+    can generate many chunks at once more efficiently, overwrite next_batch(size).
     """
     def __init__(self):
         Pipe.__init__(self)
@@ -315,6 +491,14 @@ class Producer(Pipe, EasyWriteMixIn):
     def __next__(self):
         raise StopIteration
 
+    def next_batch(self, size=None):
+        if size is None:
+            size = BATCH_SIZE
+        output = list(itertools.islice(self, size))
+        if not output:
+            raise StopIteration
+        return output
+
 
 class IteratorProducer(Producer):
     """Make a Producer from an iterator.
@@ -359,8 +543,8 @@ class FilteredProducer(Producer):
         try:
             return next(self._filter)
         except NeedData:
-            # no more data for the filter
-            if self._producer_exhausted:
+            # no more data for the filter, or it stopped in next_batch() already
+            if self._producer_exhausted or self._filter._exhausted:
                 raise StopIteration
             while True:
                 # StopIteration of the producer means we have to call last on the filter
@@ -376,6 +560,20 @@ class FilteredProducer(Producer):
                     if self._producer_exhausted:
                         raise StopIteration
 
+    def next_batch(self, size=None):
+        # Same as next(), but moving lists of chunks
+        while True:
+            try:
+                return self._filter.next_batch()
+            except NeedData:
+                if self._producer_exhausted:
+                    raise StopIteration
+            try:
+                self._filter.send_batch(self._producer.next_batch(size))
+            except StopIteration:
+                self._producer_exhausted = True
+                self._filter.last()
+
     def __repr__(self):
         return "FilteredProducer(%s, %s)" % (repr(self._producer), repr(self._filter))
 
@@ -383,6 +581,91 @@ class FilteredProducer(Producer):
         return " | ".join((str(self._producer), str(self._filter)))
 
 
+class FusedFilter(Filter):
+    """A run of Filters implementing _process_chunk, fused into one Filter.
+    Chunks are passed through the _process_chunk (or, for batches, the
+    _process_batch) functions of all fused Filters in one loop, without
+    the protocol overhead between them. Usually created by fuse().
+    """
+    def __init__(self, filters):
+        Filter.__init__(self)
+        self._filters = list(filters)
+        self._steps = [filter_._process_chunk for filter_ in self._filters]
+
+    def __enter__(self):
+        self._filters = [filter_.__enter__() for filter_ in self._filters]
+        self._steps = [filter_._process_chunk for filter_ in self._filters]
+        return self
+
+    def __exit__(self, type_=None, value=None, traceback=None):
+        for filter_ in self._filters:
+            filter_.__exit__()
+
+    def _process_chunk(self, chunk):
+        for step in self._steps:
+            chunk = step(chunk)
+        return chunk
+
+    def _process_batch(self, chunks):
+        for filter_ in self._filters:
+            if not chunks:
+                break
+            chunks = filter_._process_batch(chunks)
+        return chunks
+
+    def __str__(self):
+        return ' | '.join([str(filter_) for filter_ in self._filters])
+
+
+def _is_fusable(filter_):
+    """Filters which only implement _process_chunk can be fused."""
+    return isinstance(filter_, Filter) and type(filter_).__next__ is Filter.__next__
+
+def _filter_stages(filter_):
+    """The list of stages of a (Combined)Filter."""
+    if isinstance(filter_, CombinedFilter):
+        return list(filter_._stages)
+    return [filter_]
+
+def _fuse_stages(stages):
+    """Combine the given list of stages into one Filter, fusing runs of
+    fusable Filters."""
+    fused = []
+    run = []
+    for stage in stages + [None]:
+        if stage is not None and _is_fusable(stage):
+            run.append(stage)
+            continue
+        if len(run) > 1:
+            fused.append(FusedFilter(run))
+        else:
+            fused.extend(run)
+        run = []
+        if stage is not None:
+            fused.append(stage)
+    if len(fused) == 1:
+        return fused[0]
+    return CombinedFilter(*fused)
+
+def fuse(pipe):
+    """Compile the given Producer or Filter pipe, fusing runs of Filters that
+    yield one or no chunk of output per chunk of input (Filters implementing
+    _process_chunk) into one FusedFilter each. The resulting pipe produces
+    the same output with less overhead per chunk.
+    fuse has to be called before the pipe is used:
+    fuse(producer | filter1 | filter2 | filter3) > 'filename'
+    """
+    if isinstance(pipe, FilteredProducer):
+        stages = []
+        while isinstance(pipe, FilteredProducer):
+            stages[:0] = _filter_stages(pipe._filter)
+            pipe = pipe._producer
+        return FilteredProducer(pipe, _fuse_stages(stages))
+    elif isinstance(pipe, RawFilter):
+        return _fuse_stages(_filter_stages(pipe))
+    return pipe
+
+
 class Sink(Pipe):
     """Pulling data if connected to a Source, otherwise
     waits to be connected.
@@ -390,7 +673,9 @@ class Sink(Pipe):
     evaluate to some result.
 
     When subclassing, you should overwrite the send function and 
-    the result function.
+    the result function. Sinks pull chunks in batches, if your Sink can
+    consume a list of chunks more efficiently than one by one, overwrite
+    the send_batch function, too.
     """
     def __init__(self):
         Pipe.__init__(self)
@@ -398,9 +683,13 @@ class Sink(Pipe):
 
     def _pull(self, source):
         source = source.__enter__()
-        for chunk in source:
+        while True:
+            try:
+                chunks = source.next_batch()
+            except StopIteration:
+                break
             try:
-                self.send(chunk)
+                self.send_batch(chunks)
             except StopIteration:
                 break
         source.__exit__()
@@ -423,6 +712,10 @@ class Sink(Pipe):
     def send(self, chunk):
         raise StopIteration
 
+    def send_batch(self, chunks):
+        for chunk in chunks:
+            self.send(chunk)
+
 class SinkNeedsAll(Sink):
     """Highlevel Sink base class for sinks that need the complete data set.
     When subclassing, just provide a result() function, which can rely on
@@ -435,6 +728,9 @@ class SinkNeedsAll(Sink):
     def send(self, chunk):
         self._input.append(chunk)
 
+    def send_batch(self, chunks):
+        self._input.extend(chunks)
+
 class FilteredSink(Sink):
     def __init__(self, filter_, sink):
         Sink.__init__(self)
@@ -464,15 +760,164 @@ class FilteredSink(Sink):
             except NeedData:
                 break
 
+    def send_batch(self, chunks):
+        if self._premature_close:
+            raise StopIteration
+        self._filter.send_batch(chunks)
+        while True:
+            try:
+                self._sink.send_batch(self._filter.next_batch())
+            except NeedData:
+                break
+
     def __str__(self):
         return '( %s | %s )' % (str(self._filter), repr(self._sink))
 
 
+class FrozenRecord(collections.abc.Mapping):
+    """An immutable record, which behaves like a read-only dict.
+    Frozen records never need to be copied when passing them to several
+    targets. Filters which modify chunks (like the add_from_* family) get a
+    mutable copy via writable(chunk) when (and only when) they actually write,
+    so frozen records can be used anywhere a dict can be used in a pipe.
+    """
+    def __init__(self, *args, **kwargs):
+        self._data = dict(*args, **kwargs)
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def copy(self):
+        """Return a mutable copy of the record as a dict."""
+        return dict(self._data)
+
+    def __repr__(self):
+        return 'FrozenRecord(%s)' % repr(self._data)
+
+
+class CopyOnWriteDict(collections.abc.MutableMapping):
+    """A proxy to a dict, which may be shared with other proxies.
+    The dict is copied (shallowly) on the first write through the proxy, so
+    writes are never visible to other proxies of the same dict.
+    Note that values are not copied, so modifying e.g. a list stored in the
+    dict in-place is visible to all proxies.
+    """
+    def __init__(self, data):
+        if isinstance(data, CopyOnWriteDict):
+            # the other proxy has to copy on its next write again
+            data._owned = False
+            data = data._data
+        self._data = data
+        self._owned = False
+
+    def _own(self):
+        if not self._owned:
+            self._data = dict(self._data)
+            self._owned = True
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __setitem__(self, key, value):
+        self._own()
+        self._data[key] = value
+
+    def __delitem__(self, key):
+        self._own()
+        del self._data[key]
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def copy(self):
+        return dict(self._data)
+
+    def __repr__(self):
+        return 'CopyOnWriteDict(%s)' % repr(self._data)
+
+
+def writable(chunk):
+    """Return chunk, or a mutable copy of it if chunk is a FrozenRecord.
+    Filters which modify chunks have to use this before writing."""
+    if isinstance(chunk, FrozenRecord):
+        return chunk.copy()
+    return chunk
+
+# Strategies to copy chunks which are passed on to several targets
+COPY_NONE = 'none'
+COPY_SHALLOW = 'shallow'
+COPY_ON_WRITE = 'cow'
+COPY_DEEP = 'deep'
+
+# Chunks of these types never need to be copied
+_IMMUTABLE_TYPES = (str, bytes, int, float, bool, type(None), FrozenRecord)
+
+def _copy_none(chunk):
+    return chunk
+
+def _copy_shallow(chunk):
+    if isinstance(chunk, _IMMUTABLE_TYPES):
+        return chunk
+    return copy.copy(chunk)
+
+def _copy_on_write(chunk):
+    if isinstance(chunk, (dict, CopyOnWriteDict)):
+        return CopyOnWriteDict(chunk)
+    return _copy_deep(chunk)
+
+def _copy_deep(chunk):
+    if isinstance(chunk, _IMMUTABLE_TYPES):
+        return chunk
+    return copy.deepcopy(chunk)
+
+_copy_functions = {
+    COPY_NONE: _copy_none,
+    COPY_SHALLOW: _copy_shallow,
+    COPY_ON_WRITE: _copy_on_write,
+    COPY_DEEP: _copy_deep,
+    }
+
+def copy_function(strategy):
+    """Return the function copying chunks according to strategy, which is one of
+    COPY_NONE: pass on the same chunk
+    COPY_SHALLOW: pass on a shallow copy of the chunk
+    COPY_ON_WRITE: pass on a CopyOnWriteDict proxy for dicts, a deep copy otherwise
+    COPY_DEEP: pass on a deep copy of the chunk
+    Immutable chunks (strings, numbers, FrozenRecords) are never copied."""
+    try:
+        return _copy_functions[strategy]
+    except KeyError:
+        raise ValueError('Unknown copy strategy: %s' % strategy)
+
+
 class MultiSink(Sink):
-    def __init__(self, targets):
+    """Sends every chunk to all of its targets, created by sink1 & sink2.
+    As targets may modify chunks, every target gets its own copy of each
+    chunk. How chunks are copied can be chosen with the copy_strategy (see
+    copy_function), it defaults to COPY_DEEP. If you know your targets, you
+    can choose a cheaper strategy:
+    producer | (sink1 & sink2 & sink3).copy_with(COPY_ON_WRITE)
+    """
+    def __init__(self, targets, copy_strategy=COPY_DEEP):
         Sink.__init__(self)
         self._targets = targets
         self._running_targets = targets
+        self._copy = copy_function(copy_strategy)
 
     def __str__(self):
         return "(%s)" % ' & '.join(self._targets)
@@ -481,6 +926,11 @@ class MultiSink(Sink):
         self._targets.append(target)
         return self
 
+    def copy_with(self, copy_strategy):
+        """Use copy_strategy to copy chunks for the targets."""
+        self._copy = copy_function(copy_strategy)
+        return self
+
     def result(self):
         result = []
         for target in self._targets:
@@ -490,10 +940,24 @@ class MultiSink(Sink):
     def send(self, chunk):
         if not self._running_targets:
             raise StopIteration
+        copy_ = self._copy
         remaining_targets = []
         for target in self._running_targets:
             try:
-                target.send(copy.deepcopy(chunk))
+                target.send(copy_(chunk))
+                remaining_targets.append(target)
+            except StopIteration:
+                pass
+        self._running_targets = remaining_targets
+
+    def send_batch(self, chunks):
+        if not self._running_targets:
+            raise StopIteration
+        copy_ = self._copy
+        remaining_targets = []
+        for target in self._running_targets:
+            try:
+                target.send_batch([copy_(chunk) for chunk in chunks])
                 remaining_targets.append(target)
             except StopIteration:
                 pass
@@ -506,67 +970,367 @@ def unblock(file_):
     fl = fcntl.fcntl(file_, fcntl.F_GETFL)
     return fcntl.fcntl(file_, fcntl.F_SETFL, fl | os.O_NONBLOCK)
 
+# extended attribute holding the selinux context of a file
+SELINUX_XATTR = 'security.selinux'
+
+class LineSplitter(object):
+    """Splits a stream of blocks of bytes into lines (without line endings),
+    decoding them with encoding if given, so blocks may end anywhere.
+    Lines end with '\n' or '\r\n' only."""
+    def __init__(self, encoding=None):
+        if encoding is not None:
+            self._decoder = codecs.getincrementaldecoder(encoding)()
+            self._buffer = ''
+            self._newline = '\n'
+            self._cr = '\r'
+        else:
+            self._decoder = None
+            self._buffer = b''
+            self._newline = b'\n'
+            self._cr = b'\r'
+
+    def _split(self, text):
+        # str.splitlines would split on form feeds and other separators, too
+        lines = text.split(self._newline)
+        if self._cr in text:
+            cr = self._cr
+            lines = [line[:-1] if line.endswith(cr) else line for line in lines]
+        return lines
+
+    def feed(self, block):
+        """Return the list of lines completed by block."""
+        if self._decoder is not None:
+            block = self._decoder.decode(block)
+        buffer_ = self._buffer + block
+        cut = buffer_.rfind(self._newline)
+        if cut < 0:
+            self._buffer = buffer_
+            return []
+        self._buffer = buffer_[cut + 1:]
+        return self._split(buffer_[:cut])
+
+    def finish(self):
+        """Return the list of lines left at the end of the stream."""
+        if self._decoder is not None:
+            buffer_ = self._buffer + self._decoder.decode(b'', final=True)
+        else:
+            buffer_ = self._buffer
+        self._buffer = buffer_[:0]
+        if not buffer_:
+            return []
+        return self._split(buffer_)
+
 def permissions_from_reference(filename, reffilename, selinux=False):
     """Copies permissions (and optionally selinux contexts) from
-    reffile to file. Panics if it fails."""
+    reffile to file, which may also be given as a file descriptor.
+    Panics (raises OSError) if it fails."""
     if selinux:
-        subprocess.check_call(('/usr/bin/chcon',
-                               '--reference', reffilename,
-                               filename))
-    
-    subprocess.check_call(('/bin/chown',
-                           '--reference', reffilename,
-                           filename))
-    shutil.copymode(reffilename, filename)
+        os.setxattr(filename, SELINUX_XATTR, os.getxattr(reffilename, SELINUX_XATTR))
+
+    reference = os.stat(reffilename)
+    os.chown(filename, reference.st_uid, reference.st_gid)
+    os.chmod(filename, stat.S_IMODE(reference.st_mode))
+
+
+def fsync_file(filename):
+    """fsync the given file or directory."""
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+# Stack of active transactions, the innermost is last
+_transactions = []
+
+def current_transaction():
+    """Return the innermost active transaction, None if there is none."""
+    if _transactions:
+        return _transactions[-1]
+    return None
+
+class transaction(object):
+    """Group commit of files written securely inside of it:
+    with transaction():
+        users | to_passwd_line() > '/etc/passwd'
+        users | to_shadow_line() > '/etc/shadow'
+    Instead of being synced and renamed one by one, the new files are
+    collected. When leaving the with block, all of them are fsynced in
+    parallel (using up to workers threads), then renamed into place, then
+    each touched directory is fsynced once.
+    If an exception leaves the with block, all new files are removed, so
+    none of the targets is touched.
+    """
+    def __init__(self, workers=8):
+        self._workers = workers
+        # new file -> (target, committed), or None while it is being written
+        self._files = collections.OrderedDict()
+
+    def __enter__(self):
+        _transactions.append(self)
+        return self
+
+    def __exit__(self, type_=None, value=None, traceback=None):
+        _transactions.remove(self)
+        if type_ is None:
+            self.commit()
+        else:
+            self.abort()
+
+    def track(self, new):
+        """Register the file new as being (re)written. It is removed if the
+        transaction is aborted, and only renamed if it is added afterwards."""
+        self._files.pop(new, None)
+        self._files[new] = None
+
+    def add(self, new, target, committed=None):
+        """Add the file new (already closed), which has to be renamed to target.
+        committed is called after the rename if given. If new was added
+        before, the last one wins."""
+        self._files.pop(new, None)
+        self._files[new] = (target, committed)
+
+    def commit(self):
+        files = [(new, entry[0], entry[1]) for new, entry in self._files.items()
+                 if entry is not None]
+        try:
+            with concurrent.futures.ThreadPoolExecutor(self._workers) as executor:
+                list(executor.map(fsync_file, [new for new, _, _ in files]))
+        except:
+            self.abort()
+            raise
+        self._files = collections.OrderedDict()
+        directories = set()
+        for new, target, committed in files:
+            os.rename(new, target)
+            directories.add(os.path.dirname(os.path.abspath(target)))
+            if committed is not None:
+                committed()
+        for directory in directories:
+            fsync_file(directory)
+
+    def abort(self):
+        files, self._files = self._files, collections.OrderedDict()
+        for new in files:
+            try:
+                os.unlink(new)
+            except FileNotFoundError:
+                pass
+
 
+WriteSummary = collections.namedtuple('WriteSummary', ['written', 'unchanged', 'failed'])
 
 class write_securely_to_file_template(Sink):
-    """A sink that writes securely to files given a template."""
-    def __init__(self, key, target_template, selinux=False):
+    """A sink that writes securely to files given a template.
+    For every chunk, chunk[key] is written to the file target_template % chunk.
+    If workers is given, files are written in batched mode by a pool of workers
+    threads: files whose content is unchanged are skipped and the new files are
+    synced and renamed into place in one group commit in result() (or by the
+    surrounding transaction, if any). Failed files are reported, not raised.
+    result() evaluates to a WriteSummary of the written, unchanged and failed
+    (together with the exception) targets.
+    If several chunks map to the same target, the last one wins.
+    """
+    def __init__(self, key, target_template, selinux=False, workers=None):
         Sink.__init__(self)
         self._selinux = selinux
         self.target_template = target_template
         self.key = key
+        self._workers = workers
+        self._summary = WriteSummary([], [], [])
+        self._targets = set()
+        if workers is not None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(workers)
+            self._futures = collections.deque()
+            self._encoding = locale.getpreferredencoding(False)
             
     def send(self, chunk):
-        # need to do the whole dance - open file, write it, close it.
         target = self.target_template % chunk
+        content = ''.join((chunk[self.key], '\n'))
+        if self._workers is not None:
+            if target in self._targets:
+                self._supersede(target)
+            self._targets.add(target)
+            if len(self._futures) >= 4 * self._workers:
+                self._collect(self._futures.popleft())
+            transaction_ = current_transaction()
+            if transaction_ is not None:
+                transaction_.track(target + '.new')
+            future = self._executor.submit(self._write_if_changed, target, content)
+            self._futures.append((target, future))
+            return
+        # need to do the whole dance - open file, write it, close it.
+        transaction_ = current_transaction()
+        if transaction_ is not None:
+            transaction_.track(target + '.new')
         fd = open(target + '.new', 'w')
         if os.path.isfile(target):
-            permissions_from_reference(target + '.new', target, self._selinux)
-        fd.write(''.join((chunk[self.key], '\n')))
+            permissions_from_reference(fd.fileno(), target, self._selinux)
+        fd.write(content)
         fd.flush()
+        if target not in self._targets:
+            self._targets.add(target)
+            self._summary.written.append(target)
+        if transaction_ is not None:
+            fd.close()
+            transaction_.add(target + '.new', target)
+            return
         os.fsync(fd.fileno())
+        fd.close()
         shutil.move(target + '.new', target)
 
+    def _write_if_changed(self, target, content):
+        """Write content to target.new unless target has this content already.
+        Returns True if target.new was written."""
+        data = content.encode(self._encoding)
+        try:
+            with open(target, 'rb') as fd:
+                if fd.read(len(data) + 1) == data:
+                    return False
+        except FileNotFoundError:
+            pass
+        try:
+            with open(target + '.new', 'wb') as fd:
+                if os.path.isfile(target):
+                    permissions_from_reference(fd.fileno(), target, self._selinux)
+                fd.write(data)
+        except:
+            if os.path.exists(target + '.new'):
+                os.unlink(target + '.new')
+            raise
+        return True
+
+    def _supersede(self, target):
+        """Forget an earlier write of target, so only one is pending at a time."""
+        for pending in self._futures:
+            if pending[0] == target:
+                self._futures.remove(pending)
+                if pending[1].cancel():
+                    return
+                self._collect(pending)
+                break
+        summary = self._summary
+        if target in summary.written:
+            summary.written.remove(target)
+            os.unlink(target + '.new')
+        elif target in summary.unchanged:
+            summary.unchanged.remove(target)
+
+    def _collect(self, pending):
+        target, future = pending
+        try:
+            if future.result():
+                self._summary.written.append(target)
+            else:
+                self._summary.unchanged.append(target)
+        except Exception as err:
+            self._summary.failed.append((target, err))
+
+    def result(self):
+        if self._workers is not None:
+            while self._futures:
+                self._collect(self._futures.popleft())
+            self._executor.shutdown()
+            transaction_ = current_transaction()
+            if transaction_ is not None:
+                for target in self._summary.written:
+                    transaction_.add(target + '.new', target)
+            else:
+                with transaction(self._workers) as transaction_:
+                    for target in self._summary.written:
+                        transaction_.add(target + '.new', target)
+        return self._summary
+
+
+def file_digest(filename):
+    """Return the sha256 hexdigest of the file's content, None if the file
+    doesn't exist."""
+    digest = hashlib.sha256()
+    try:
+        with open(filename, 'rb') as fd:
+            for block in iter(lambda: fd.read(65536), b''):
+                digest.update(block)
+    except FileNotFoundError:
+        return None
+    return digest.hexdigest()
+
 
 class write_securely_to_file(Sink):
     """A sink that writes securely to a file given as a filename.
     Alternatively, if you give it a file-like object, it will naively write to it.
+    If only_if_changed is True, the digest of the written content is compared
+    to the existing file, and if they are the same, the file is not replaced.
+    If you give a mapping of filenames to digests as digests, it is used as a
+    cache of the existing file's digest and updated after writing.
+    result() evaluates to True if the file was written, False if it was
+    unchanged.
     """
-    def __init__(self, target, selinux=False):
+    def __init__(self, target, selinux=False, only_if_changed=False, digests=None):
         Sink.__init__(self)
         self._selinux = selinux
+        self._hash = None
         if type(target) in (str,):
             self._managed = True
+            transaction_ = current_transaction()
+            if transaction_ is not None:
+                transaction_.track(target + '.new')
             self._fd = open(target + '.new', 'w')
             self._target = target
             if os.path.isfile(target):
-                permissions_from_reference(target + '.new', target, selinux)
+                permissions_from_reference(self._fd.fileno(), target, selinux)
+            if only_if_changed:
+                self._hash = hashlib.sha256()
+                self._digests = digests
         else:
             self._managed = False
             self._fd = target
 
+    def _write(self, data):
+        self._fd.write(data)
+        if self._hash is not None:
+            self._hash.update(data.encode(self._fd.encoding))
+
+    def _unchanged(self):
+        """Check if the written file is the same as the existing target."""
+        digest = self._hash.hexdigest()
+        # the cached digest is only trusted if the target is still there
+        try:
+            if os.path.getsize(self._target) != os.fstat(self._fd.fileno()).st_size:
+                return False
+        except FileNotFoundError:
+            return False
+        if self._digests is not None and self._target in self._digests:
+            return self._digests[self._target] == digest
+        return file_digest(self._target) == digest
+
     def result(self):
         if self._managed:
             self._fd.flush()
+            if self._hash is not None and self._unchanged():
+                self._fd.close()
+                os.unlink(self._target + '.new')
+                return False
+            transaction_ = current_transaction()
+            if transaction_ is not None:
+                self._fd.close()
+                transaction_.add(self._target + '.new', self._target, self._committed)
+                return True
             os.fsync(self._fd.fileno())
             self._fd.close()
             shutil.move(self._target + '.new', self._target)
+            self._committed()
         return True
+
+    def _committed(self):
+        if self._hash is not None and self._digests is not None:
+            self._digests[self._target] = self._hash.hexdigest()
             
     def send(self, chunk):
-        self._fd.write(''.join((chunk, '\n')))
+        self._write(''.join((chunk, '\n')))
+
+    def send_batch(self, chunks):
+        self._write(''.join([chunk + '\n' for chunk in chunks]))
 
 class append_to_file(write_securely_to_file):
     def __init__(self, target):
@@ -40,7 +40,19 @@ import logging
 import shlex
 import subprocess
 import types
-import copy
+import collections
+import collections.abc
+import hashlib
+import math
+import operator
+import heapq
+import pickle
+import tempfile
+import queue
+import threading
+import multiprocessing
+import concurrent.futures
+import selectors
 
 from . import base
 
@@ -48,28 +60,29 @@ logger = logging.getLogger('genconfig')
 
 class tee(base.Filter):
     """Dumps whatever comes along and passes it on."""
-    def __next__(self):
-        chunk = self._chunk
+    def _process_chunk(self, chunk):
         print(chunk)
         return chunk
 
 class cat(base.Filter):
     """for list | cat > file constructs"""
-    def __next__(self):
-        return self._chunk
+    def _process_batch(self, chunks):
+        return chunks
 
 class where(base.Filter):
     def __init__(self, testing_function):
         base.Filter.__init__(self)
         self._testing_function = testing_function
 
-    def __next__(self):
-        chunk = self._chunk
+    def _process_chunk(self, chunk):
         if self._testing_function(chunk):
             return chunk
         else:
             raise base.NeedData
 
+    def _process_batch(self, chunks):
+        return [chunk for chunk in chunks if self._testing_function(chunk)]
+
 class inject_from_producer(base.Filter):
     """Ignores input, produces instead."""
     def __init__(self, producer):
@@ -79,16 +92,76 @@ class inject_from_producer(base.Filter):
     def __next__(self):
         return next(self._producer)
 
+def _run_branch(filter_, inbox, outbox):
+    """Run a branch of a parallel multiply_chunk.
+    Takes rounds of input ('start', 'send' with a chunk or 'last') from
+    inbox and puts (output, exhausted, error) for every round into outbox,
+    until it gets None."""
+    error = None
+    exhausted = False
+    try:
+        filter_ = filter_.__enter__()
+    except Exception as err:
+        error = err
+    while True:
+        message = inbox.get()
+        if message is None:
+            break
+        kind, chunk = message
+        output = []
+        if not exhausted and error is None:
+            try:
+                if kind == 'send':
+                    filter_.send(chunk)
+                elif kind == 'last':
+                    filter_.last()
+                while True:
+                    output.append(next(filter_))
+            except base.NeedData:
+                pass
+            except StopIteration:
+                exhausted = True
+            except Exception as err:
+                error = err
+        outbox.put((output, exhausted, error))
+    if error is None:
+        filter_.__exit__()
+
 class multiply_chunk(base.RawFilter):
     """Passes chunks trough each supplied filter in turn, yielding all outputs
     after each other. You can use this to have one producer pass chunks to
     one sink through multiple, parallel filters such that the sink gets the output
-    of each parallel filter in turn."""
-    def __init__(self, *filters):
+    of each parallel filter in turn.
+    Every filter gets its own copy of each chunk, how chunks are copied can be
+    chosen with copy_strategy (see base.copy_function, default is COPY_DEEP).
+    If parallel is 'thread' or 'process', each filter runs in its own thread or
+    process, fed via queues holding at most queue_size chunks. Up to queue_size
+    chunks are in flight, the output is the same as without parallel. In a
+    process, filters (and chunks) have to be picklable, and get their own copies
+    of chunks anyway. In threads, copy_strategy defaults to COPY_ON_WRITE, so
+    dicts are shared read-only and only copied by filters setting keys (the
+    filters must not modify values like lists in place then), and dicts are
+    passed on as base.CopyOnWriteDict mappings."""
+    def __init__(self, *filters, parallel=None, queue_size=16, copy_strategy=None):
         base.RawFilter.__init__(self)
         self._filterobjects = filters
+        self._parallel = parallel
+        self._queue_size = queue_size
+        if copy_strategy is None:
+            if parallel == 'thread':
+                copy_strategy = base.COPY_ON_WRITE
+            else:
+                copy_strategy = base.COPY_DEEP
+        if parallel == 'process':
+            self._copy = base.copy_function(base.COPY_NONE)
+        else:
+            self._copy = base.copy_function(copy_strategy)
+        if parallel not in (None, 'thread', 'process'):
+            raise ValueError('parallel has to be None, "thread" or "process"')
 
     def __enter__(self):
+        if self._parallel is not None:
+            return self._start_workers()
         self._filters = []
         self._exhausted_filters = []
         for filterobject in self._filterobjects:
@@ -97,10 +170,15 @@ class multiply_chunk(base.RawFilter):
         return self
 
     def __exit__(self, type_=None, value=None, traceback=None):
+        if self._parallel is not None:
+            return self._stop_workers()
         for filt in self._filters + self._exhausted_filters:
             filt.__exit__(type_=None, value=None, traceback=None)
     
     def last(self):
+        if self._parallel is not None:
+            self._last = True
+            return self._put_round('last')
         for filt in self._filters:
             filt.last()
         self._reset_filters_with_enough_data()
@@ -109,11 +187,15 @@ class multiply_chunk(base.RawFilter):
         self._filters_with_enough_data = [x for x in self._filters] # copy not pointer
 
     def send(self, chunk):
+        if self._parallel is not None:
+            return self._put_round('send', chunk)
         for filt in self._filters:
-            filt.send(copy.deepcopy(chunk))
+            filt.send(self._copy(chunk))
         self._reset_filters_with_enough_data()
 
     def __next__(self):
+        if self._parallel is not None:
+            return self._next_parallel()
         if len(self._filters_with_enough_data) == 0: # no one has enough data at the moment
             if len(self._filters) == 0: # everyone is completely exhausted
                 raise StopIteration
@@ -138,6 +220,85 @@ class multiply_chunk(base.RawFilter):
         else:
             # all filters exhausted
             raise StopIteration
+
+    def _start_workers(self):
+        if self._parallel == 'thread':
+            queue_class, worker_class = queue.Queue, threading.Thread
+        else:
+            queue_class, worker_class = multiprocessing.Queue, multiprocessing.Process
+        self._inboxes = []
+        self._outboxes = []
+        self._workers = []
+        for filterobject in self._filterobjects:
+            inbox = queue_class(self._queue_size + 1)
+            outbox = queue_class(self._queue_size + 1)
+            worker = worker_class(target=_run_branch, args=(filterobject, inbox, outbox))
+            worker.daemon = True
+            worker.start()
+            self._inboxes.append(inbox)
+            self._outboxes.append(outbox)
+            self._workers.append(worker)
+        self._output = collections.deque()
+        self._in_flight = 0
+        self._live_branches = set(range(len(self._workers)))
+        self._put_round('start')
+        return self
+
+    def _stop_workers(self):
+        # If the pipe is closed early, workers may be blocked putting output
+        # nobody reads any more (and a process can't exit before its queued
+        # output is read), so drain the outboxes until all workers are gone.
+        stopping = [False] * len(self._workers)
+        while True:
+            alive = False
+            for i, (inbox, outbox, worker) in enumerate(zip(self._inboxes, self._outboxes, self._workers)):
+                if not stopping[i]:
+                    try:
+                        inbox.put_nowait(None)
+                        stopping[i] = True
+                    except queue.Full:
+                        pass
+                try:
+                    while True:
+                        outbox.get_nowait()
+                except queue.Empty:
+                    pass
+                worker.join(0.01)
+                alive = alive or worker.is_alive()
+            if not alive:
+                break
+
+    def _put_round(self, kind, chunk=None):
+        for inbox in self._inboxes:
+            inbox.put((kind, self._copy(chunk)))
+        self._in_flight += 1
+
+    def _get_round(self):
+        # Collect the output of the oldest round in branch order
+        for i, outbox in enumerate(self._outboxes):
+            output, exhausted, error = outbox.get()
+            if error is not None:
+                raise error
+            self._output.extend(output)
+            if exhausted:
+                self._live_branches.discard(i)
+        self._in_flight -= 1
+
+    def _next_parallel(self):
+        while not self._output:
+            if not self._live_branches:
+                raise StopIteration
+            if self._in_flight == 0:
+                if self._last:
+                    raise StopIteration
+                raise base.NeedData
+            # Let the branches work on more input unless the oldest round is
+            # done already, the window is full or there won't be more input.
+            if (not self._last and self._in_flight < self._queue_size
+                and any(outbox.empty() for outbox in self._outboxes)):
+                raise base.NeedData
+            self._get_round()
+        return self._output.popleft()
     
     def __str__(self):
         return "multiply_chunk(" + ', '.join([str(x) for x in self._filterobjects]) + ')'
@@ -153,8 +314,7 @@ class CheckLog(base.Filter):
         self._key = key
 
     _loglevel = logging.WARN
-    def __next__(self):
-        chunk = self._chunk
+    def _process_chunk(self, chunk):
         if self._testing_function(chunk[self._key]):
             return chunk
         else:
@@ -187,14 +347,112 @@ class skip_while(base.Filter):
             raise base.NeedData
         return chunk
 
+def _read_run(file_, single=False):
+    # single: pickled one chunk at a time instead of in lists
+    while True:
+        try:
+            chunks = pickle.load(file_)
+        except EOFError:
+            return
+        if single:
+            yield chunks
+        else:
+            yield from chunks
+
+# Number of chunks pickled at once when spilling sorted runs
+SPILL_BATCH_SIZE = 1024
+
 class sort(base.FilterNeedsAll):
-    def __init__(self, key=None, reverse=False):
+    """Sorts the chunks like sorted(chunks, key=key, reverse=reverse).
+    If run_size is given, at most about run_size chunks are kept in memory:
+    sorted runs of run_size chunks are pickled to temporary files (in tmpdir)
+    and merged when all input is there. Chunks have to be picklable then."""
+    def __init__(self, key=None, reverse=False, run_size=None, tmpdir=None):
         base.FilterNeedsAll.__init__(self)
         self._key = key
         self._reverse = reverse
+        self._run_size = run_size
+        self._tmpdir = tmpdir
+        self._runs = []
+
+    def __exit__(self, type_=None, value=None, traceback=None):
+        for run in self._runs:
+            run.close()
+        self._runs = []
+
+    def _spill(self):
+        run = sorted(self._input, key=self._key, reverse=self._reverse)
+        self._input = []
+        file_ = tempfile.TemporaryFile(dir=self._tmpdir)
+        for i in range(0, len(run), SPILL_BATCH_SIZE):
+            pickle.dump(run[i:i+SPILL_BATCH_SIZE], file_, pickle.HIGHEST_PROTOCOL)
+        file_.seek(0)
+        self._runs.append(file_)
+
+    def send(self, chunk):
+        base.FilterNeedsAll.send(self, chunk)
+        if self._run_size is not None and len(self._input) >= self._run_size:
+            self._spill()
+
+    def send_batch(self, chunks):
+        base.FilterNeedsAll.send_batch(self, chunks)
+        if self._run_size is not None and len(self._input) >= self._run_size:
+            self._spill()
 
     def _process(self, _input):
-        return sorted(_input, key=self._key, reverse=self._reverse)
+        last_run = sorted(_input, key=self._key, reverse=self._reverse)
+        if not self._runs:
+            return last_run
+        # heapq.merge takes equal chunks from earlier runs first, so this is stable
+        runs = [_read_run(run) for run in self._runs]
+        runs.append(last_run)
+        return heapq.merge(*runs, key=self._key, reverse=self._reverse)
+
+    def _absorb(self, following):
+        # sort | take(n) only needs the first n chunks
+        if type(following) is take:
+            return top_n(following._left, key=self._key, reverse=self._reverse)
+        return None
+
+class top_n(base.FilterNeedsAll):
+    """Passes on the first n chunks of the sorted input, like
+    sort(key=key, reverse=reverse) | take(n), but keeping only about
+    2*n chunks in memory instead of all."""
+    def __init__(self, n, key=None, reverse=False):
+        base.FilterNeedsAll.__init__(self)
+        self._n = max(n, 0)
+        self._key = key
+        self._reverse = reverse
+
+    def _prune(self):
+        # nsmallest and nlargest are stable like sorted, and the kept chunks
+        # come before all chunks sent later
+        if self._reverse:
+            self._input = heapq.nlargest(self._n, self._input, key=self._key)
+        else:
+            self._input = heapq.nsmallest(self._n, self._input, key=self._key)
+
+    def send(self, chunk):
+        base.FilterNeedsAll.send(self, chunk)
+        if len(self._input) > 2 * self._n + base.BATCH_SIZE:
+            self._prune()
+
+    def send_batch(self, chunks):
+        base.FilterNeedsAll.send_batch(self, chunks)
+        if len(self._input) > 2 * self._n + base.BATCH_SIZE:
+            self._prune()
+
+    def _process(self, _input):
+        self._prune()
+        return self._input
+
+    def _absorb(self, following):
+        if type(following) is take:
+            return top_n(min(self._n, following._left), key=self._key, reverse=self._reverse)
+        return None
+
+    def __str__(self):
+        return 'top_n(%d)' % self._n
 
 class reverse(base.FilterNeedsAll):
     def _process(self, _input):
@@ -238,15 +496,119 @@ class skip(base.Filter):
         base.Filter.__init__(self)
         self._to_go = n
 
-    def __next__(self):
-        chunk = self._chunk
+    def _process_chunk(self, chunk):
         if self._to_go > 0:
             self._to_go -= 1
             raise base.NeedData
         return chunk
 
+class _Coprocess(object):
+    """A child process which is fed via its stdin and read from via its stdout
+    without ever blocking on one of them while the other one is stuck.
+    Input is buffered in write(), output lines are collected in lines
+    whenever pump() is called."""
+    def __init__(self, args, kwargs, encoding=None):
+        self._process = subprocess.Popen(args,
+                                         stdout=subprocess.PIPE,
+                                         stdin=subprocess.PIPE,
+                                         **kwargs)
+        self._stdin = self._process.stdin
+        self._stdout = self._process.stdout
+        base.unblock(self._stdin)
+        base.unblock(self._stdout)
+        self._encoding = encoding
+        self._input = bytearray()
+        self._closing = False
+        self.eof = False
+        self.lines = collections.deque()
+        self._splitter = base.LineSplitter(encoding)
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._stdout, selectors.EVENT_READ)
+        self._writing = False
+
+    def write(self, chunk):
+        """Buffer chunk as a line of input."""
+        if self._stdin.closed:
+            # the process won't read any more input
+            return
+        if self._encoding is not None:
+            chunk = chunk.encode(self._encoding)
+        self._input += chunk
+        self._input += b'\n'
+
+    def buffered(self):
+        """The number of bytes of input not yet written."""
+        return len(self._input)
+
+    def close(self):
+        """Close stdin as soon as all input is written."""
+        self._closing = True
+        self._update_stdin()
+
+    def _update_stdin(self):
+        if self._stdin.closed:
+            return
+        if self._input:
+            if not self._writing:
+                self._selector.register(self._stdin, selectors.EVENT_WRITE)
+                self._writing = True
+            return
+        if self._writing:
+            self._selector.unregister(self._stdin)
+            self._writing = False
+        if self._closing:
+            self._stdin.close()
+
+    def pump(self, block=False):
+        """Write as much input and read as much output as possible without
+        blocking. If block is True, wait until something could be done."""
+        self._update_stdin()
+        if not self._selector.get_map():
+            return
+        for key, _ in self._selector.select(None if block else 0):
+            if key.fileobj is self._stdin:
+                try:
+                    written = os.write(self._stdin.fileno(), self._input[:PIPE_BUF_SIZE])
+                    del self._input[:written]
+                except BlockingIOError:
+                    pass
+                except BrokenPipeError:
+                    # the process won't read any more input
+                    del self._input[:]
+                    self._closing = True
+                self._update_stdin()
+            else:
+                try:
+                    block_ = os.read(self._stdout.fileno(), PIPE_BUF_SIZE)
+                except BlockingIOError:
+                    continue
+                if block_:
+                    self.lines.extend(self._splitter.feed(block_))
+                else:
+                    self.lines.extend(self._splitter.finish())
+                    self._selector.unregister(self._stdout)
+                    self.eof = True
+
+    def wait(self):
+        """Wait for the process to finish and return its returncode."""
+        self._input = bytearray()
+        self._closing = True
+        self._update_stdin()
+        self._stdout.close()
+        self._selector.close()
+        return self._process.wait()
+
+# Bytes read from or written to pipes at once
+PIPE_BUF_SIZE = 65536
+
 class sh_filter(base.RawFilter):
-    def __init__(self, args, error_on_ret = False, **kwargs):
+    """Pipes chunks through a shell command, one line of input for each chunk
+    and one chunk for each line of output.
+    Chunks are strings encoded with encoding, or bytes if encoding is None.
+    Writing input and reading output is overlapped, so the command never
+    deadlocks on full pipes, and at most about buffer_size bytes of input are
+    buffered before waiting for the command to catch up."""
+    def __init__(self, args, error_on_ret = False, encoding='utf-8', buffer_size=1048576, **kwargs):
         base.RawFilter.__init__(self)
         if type(args) in (str,):
             args = shlex.split(args)
@@ -255,66 +617,547 @@ class sh_filter(base.RawFilter):
         self._args = args
         self._kwargs = kwargs
         self._error_on_ret = error_on_ret
-        if error_on_ret:
-            self._cmd = args[0]
-        self._leftover = None
+        self._cmd = args[0]
+        self._encoding = encoding
+        self._buffer_size = buffer_size
 
     def __enter__(self):
-        self._subprocess = subprocess.Popen(self._args, 
-                                            stdout=subprocess.PIPE, 
-                                            stdin=subprocess.PIPE,
-                                            **self._kwargs)
-        base.unblock(self._subprocess.stdout)
-
+        self._coprocess = _Coprocess(self._args, self._kwargs, self._encoding)
         return self
+
+    def __exit__(self, type_=None, value=None, traceback=None):
+        if self._coprocess is not None:
+            self._coprocess.wait()
     
     def last(self):
-        self._leftover = self._subprocess.communicate()[0].splitlines()
+        self._coprocess.close()
         self._last = True
 
     def send(self, chunk):
-        self._subprocess.stdin.write(''.join((chunk, '\n')))
+        coprocess = self._coprocess
+        coprocess.write(chunk)
+        while coprocess.buffered() > self._buffer_size:
+            coprocess.pump(block=True)
 
     def __next__(self):
-        # Read anything the process yields
-        try:
-            line_ = self._subprocess.stdout.readline()
-        except (IOError, ValueError):
-            if self._last:
-                if self._leftover:
-                    return self._leftover.pop(0)
-                else:
-                    if self._error_on_ret and not self._subprocess.retcode == 0:
-                        raise subprocess.CalledProcessError(self._subprocess.retcode, self._cmd)
-                raise StopIteration
-            else:
+        coprocess = self._coprocess
+        if not coprocess.lines and (self._last or coprocess.buffered() >= PIPE_BUF_SIZE):
+            coprocess.pump()
+            while self._last and not coprocess.lines and not coprocess.eof:
+                coprocess.pump(block=True)
+        if coprocess.lines:
+            return coprocess.lines.popleft()
+        if not self._last:
+            raise base.NeedData
+        returncode = coprocess.wait()
+        self._coprocess = None
+        if self._error_on_ret and not returncode == 0:
+            raise subprocess.CalledProcessError(returncode, self._cmd)
+        raise StopIteration
+
+    def __str__(self):
+        return 'sh_filter(%s)' % ' '.join(self._args)
+
+class sh_filter_pool(base.RawFilter):
+    """Like sh_filter, but pipes chunks through a pool of processes instances
+    of the command (default: one per CPU), which are kept running for the whole
+    pipeline. Chunks are distributed round-robin, or by hashing key(chunk) if
+    key is given, so equal keys end up in the same process.
+    The command has to print exactly one line of output for each line of input,
+    the output is merged back in the order of the input."""
+    def __init__(self, args, processes=None, key=None, error_on_ret = False, encoding='utf-8', buffer_size=1048576, **kwargs):
+        base.RawFilter.__init__(self)
+        if type(args) in (str,):
+            args = shlex.split(args)
+        if 'stdin' in kwargs or 'stdout' in kwargs:
+            raise ValueError("Can't reroute stdin or stdout, they are piped!")
+        self._args = args
+        self._kwargs = kwargs
+        self._processes = processes or os.cpu_count() or 1
+        self._key = key
+        self._error_on_ret = error_on_ret
+        self._cmd = args[0]
+        self._encoding = encoding
+        self._buffer_size = buffer_size
+
+    def __enter__(self):
+        self._coprocesses = [_Coprocess(self._args, self._kwargs, self._encoding)
+                             for i in range(self._processes)]
+        # the index of the coprocess each pending chunk was sent to
+        self._order = collections.deque()
+        self._next_coprocess = 0
+        return self
+
+    def __exit__(self, type_=None, value=None, traceback=None):
+        if self._coprocesses is not None:
+            self._wait()
+
+    def _wait(self):
+        returncodes = [coprocess.wait() for coprocess in self._coprocesses]
+        self._coprocesses = None
+        if self._error_on_ret:
+            for returncode in returncodes:
+                if not returncode == 0:
+                    raise subprocess.CalledProcessError(returncode, self._cmd)
+
+    def last(self):
+        for coprocess in self._coprocesses:
+            coprocess.close()
+        self._last = True
+
+    def send(self, chunk):
+        if self._key is None:
+            index = self._next_coprocess
+            self._next_coprocess = (index + 1) % self._processes
+        else:
+            index = hash(self._key(chunk)) % self._processes
+        coprocess = self._coprocesses[index]
+        coprocess.write(chunk)
+        self._order.append(index)
+        # keep all processes busy, not only the one the output is waited for
+        if coprocess.buffered() >= PIPE_BUF_SIZE:
+            coprocess.pump()
+        while coprocess.buffered() > self._buffer_size:
+            coprocess.pump(block=True)
+
+    def __next__(self):
+        if not self._order:
+            if not self._last:
                 raise base.NeedData
-        if line_ == '':
+            unread = any(coprocess.lines for coprocess in self._coprocesses)
+            self._wait()
+            if unread:
+                raise ValueError('%s printed more lines than it was sent' % self._cmd)
             raise StopIteration
-        return line_.splitlines()[0]
+        coprocess = self._coprocesses[self._order[0]]
+        if not coprocess.lines and (self._last or coprocess.buffered() >= PIPE_BUF_SIZE):
+            coprocess.pump()
+            while self._last and not coprocess.lines and not coprocess.eof:
+                coprocess.pump(block=True)
+        if coprocess.lines:
+            self._order.popleft()
+            return coprocess.lines.popleft()
+        if not coprocess.eof:
+            raise base.NeedData
+        self._wait()
+        raise ValueError('%s printed less lines than it was sent' % self._cmd)
+
+    def __str__(self):
+        return 'sh_filter_pool(%s)' % ' '.join(self._args)
+
+def _fingerprint(value):
+    """A hashable stand-in for value, equal only for equal values (so dicts
+    and lists can be compared via hashing)."""
+    try:
+        hash(value)
+        return value
+    except TypeError:
+        pass
+    if isinstance(value, collections.abc.Mapping):
+        return (_UNHASHABLE, collections.abc.Mapping,
+                frozenset([(k, _fingerprint(v)) for k, v in value.items()]))
+    if isinstance(value, collections.abc.Set):
+        # elements of sets are hashable, and sets equal frozensets
+        return frozenset(value)
+    if isinstance(value, collections.abc.Iterable):
+        # lists equal lists (of any subclass), tuples equal tuples
+        if isinstance(value, list):
+            kind = list
+        elif isinstance(value, tuple):
+            kind = tuple
+        else:
+            kind = type(value)
+        return (_UNHASHABLE, kind, tuple([_fingerprint(v) for v in value]))
+    return (_UNHASHABLE, type(value), repr(value))
+
+# marks fingerprints of unhashable values, so they can't equal hashable chunks
+_UNHASHABLE = object()
+
+class _BloomFilter(object):
+    """A set of fixed size (in bytes) which may err by containing values
+    never added, with a probability of about error_rate as long as
+    capacity values were added at most."""
+    def __init__(self, size, error_rate):
+        self._bits = bytearray(size)
+        self._m = 8 * size
+        self._k = max(1, round(-math.log2(error_rate)))
+        self.capacity = int(self._m * math.log(2) ** 2 / -math.log(error_rate))
+
+    def add(self, value):
+        """Add value, return whether it was (probably) contained already."""
+        digest = hashlib.blake2b((hash(value) & 0xffffffffffffffff).to_bytes(8, 'little'),
+                                 digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        bits = self._bits
+        m = self._m
+        contained = True
+        for i in range(self._k):
+            position = (h1 + i * h2) % m
+            mask = 1 << (position & 7)
+            if not bits[position >> 3] & mask:
+                bits[position >> 3] |= mask
+                contained = False
+        return contained
 
 class unique(base.Filter):
-    def __init__(self):
+    """Drops chunks equal to an earlier chunk, or with a key(chunk) equal to
+    the key of an earlier chunk if key is given. Unhashable values like
+    dicts or lists are compared via a canonical fingerprint.
+    If approximate is True, seen values are remembered in a Bloom filter of
+    max_memory bytes instead of a set, which drops a unique chunk with a
+    probability of about error_rate (rising if the stream is too long
+    for max_memory)."""
+    def __init__(self, key=None, approximate=False, error_rate=0.001, max_memory=16*1024*1024):
         base.Filter.__init__(self)
-        self._seen = []
+        self._key = key
+        self._approximate = approximate
+        self._error_rate = error_rate
+        self._max_memory = max_memory
 
-    def __next__(self):
-        chunk = self._chunk
-        if chunk not in self._seen:
-            self._seen.append(chunk)
+    def __enter__(self):
+        if self._approximate:
+            self._seen = _BloomFilter(self._max_memory, self._error_rate)
+            self._count = 0
+        else:
+            self._seen = set()
+        return self
+
+    def _process_chunk(self, chunk):
+        value = chunk if self._key is None else self._key(chunk)
+        value = _fingerprint(value)
+        if self._approximate:
+            if self._seen.add(value):
+                raise base.NeedData
+            self._count += 1
+            if self._count == self._seen.capacity + 1:
+                logger.warning('%s: more than %d unique chunks, the error rate exceeds %g',
+                               self, self._seen.capacity, self._error_rate)
             return chunk
-        raise base.NeedData
+        if value in self._seen:
+            raise base.NeedData
+        self._seen.add(value)
+        return chunk
 
     def __str__(self):
         return 'unique()'
 
+class Aggregation(object):
+    """Base class for aggregations used by group_by.
+    value is a key of the chunks, a function of the chunks or None
+    (the chunk itself) and gives the value to aggregate. Subclasses provide
+    initial(), add(state, value) returning the new state and optionally
+    result(state)."""
+    def __init__(self, value=None):
+        if value is None:
+            self.value = lambda chunk: chunk
+        elif callable(value):
+            self.value = value
+        else:
+            self.value = operator.itemgetter(value)
+
+    def initial(self):
+        return None
+
+    def add(self, state, value):
+        return state
+
+    def result(self, state):
+        return state
+
+class agg_list(Aggregation):
+    """All values of the group as a list, in input order."""
+    def initial(self):
+        return []
+
+    def add(self, state, value):
+        state.append(value)
+        return state
+
+class agg_count(Aggregation):
+    """The number of chunks in the group."""
+    def initial(self):
+        return 0
+
+    def add(self, state, value):
+        return state + 1
+
+class agg_sum(Aggregation):
+    """The sum of the values of the group."""
+    def initial(self):
+        return 0
+
+    def add(self, state, value):
+        return state + value
+
+class agg_min(Aggregation):
+    """The smallest value of the group."""
+    def initial(self):
+        return _NOTHING
+
+    def add(self, state, value):
+        if state is _NOTHING or value < state:
+            return value
+        return state
+
+class agg_max(Aggregation):
+    """The largest value of the group."""
+    def initial(self):
+        return _NOTHING
+
+    def add(self, state, value):
+        if state is _NOTHING or state < value:
+            return value
+        return state
+
+class agg_first(Aggregation):
+    """The first value of the group."""
+    def initial(self):
+        return _NOTHING
+
+    def add(self, state, value):
+        if state is _NOTHING:
+            return value
+        return state
+
+class agg_union(Aggregation):
+    """The union of the values of the group, which are iterables, as a set."""
+    def initial(self):
+        return set()
+
+    def add(self, state, value):
+        state.update(value)
+        return state
+
+# state of aggregations without any value yet
+_NOTHING = object()
+
+class group_by(base.FilterNeedsAll):
+    """Groups the chunks by key and gives one dict per group, mapping the
+    names of the given aggregations to their result for the group:
+
+    users | group_by('group_name', member_list=agg_list('user_name'), gid=agg_first('gid'))
+
+    key is a key of the chunks, which is put in the output as well, a list of
+    such keys or a function of the chunks (the output contains its result as
+    key_name then). Groups are given in the order of their first chunk.
+    If max_groups is given, chunks of groups beyond the first max_groups are
+    pickled to one of partitions temporary files (in tmpdir) by hash of their
+    key, which are aggregated one after the other at the end, so order of
+    groups is not kept then and chunks have to be picklable."""
+    def __init__(self, key, key_name='key', max_groups=None, partitions=16, tmpdir=None, **aggregations):
+        base.FilterNeedsAll.__init__(self)
+        if callable(key):
+            self._key = key
+            self._key_names = None
+            self._key_name = key_name
+        else:
+            if isinstance(key, str):
+                self._key_names = None
+                self._key_name = key
+                self._key = operator.itemgetter(key)
+            else:
+                self._key_names = list(key)
+                self._key = lambda chunk: tuple([chunk[name] for name in self._key_names])
+        self._aggregations = list(aggregations.items())
+        self._max_groups = max_groups
+        self._partitions = partitions
+        self._tmpdir = tmpdir
+        self._groups = {}
+        self._spill = None
+
+    def __exit__(self, type_=None, value=None, traceback=None):
+        if self._spill is not None:
+            for file_ in self._spill:
+                file_.close()
+            self._spill = None
+
+    def _add(self, groups, chunk, spill):
+        key = self._key(chunk)
+        try:
+            states = groups[key]
+        except KeyError:
+            if spill and len(groups) >= self._max_groups:
+                self._spill_chunk(key, chunk)
+                return
+            states = groups[key] = [aggregation.initial() for name, aggregation in self._aggregations]
+        for i, (name, aggregation) in enumerate(self._aggregations):
+            states[i] = aggregation.add(states[i], aggregation.value(chunk))
+
+    def _spill_chunk(self, key, chunk):
+        if self._spill is None:
+            self._spill = [tempfile.TemporaryFile(dir=self._tmpdir)
+                           for i in range(self._partitions)]
+        pickle.dump(chunk, self._spill[hash(key) % self._partitions],
+                    pickle.HIGHEST_PROTOCOL)
+
+    def send(self, chunk):
+        self._add(self._groups, chunk, self._max_groups is not None)
+
+    def send_batch(self, chunks):
+        groups = self._groups
+        spill = self._max_groups is not None
+        for chunk in chunks:
+            self._add(groups, chunk, spill)
+
+    def _results(self, groups):
+        for key, states in groups.items():
+            if self._key_names is None:
+                result = {self._key_name: key}
+            else:
+                result = dict(zip(self._key_names, key))
+            for (name, aggregation), state in zip(self._aggregations, states):
+                result[name] = aggregation.result(state)
+            yield result
+
+    def _process(self, _input):
+        groups = self._groups
+        self._groups = {}
+        yield from self._results(groups)
+        if self._spill is None:
+            return
+        for file_ in self._spill:
+            file_.seek(0)
+            groups = {}
+            for chunk in _read_run(file_, single=True):
+                self._add(groups, chunk, False)
+            yield from self._results(groups)
+
+    def __str__(self):
+        return 'group_by(%s)' % ', '.join([name for name, aggregation in self._aggregations])
+
+def _key_function(key):
+    # key is a key of the chunks or a function of the chunks
+    if callable(key):
+        return key
+    return operator.itemgetter(key)
+
+def _join_rows(left, right):
+    if isinstance(left, collections.abc.Mapping):
+        joined = dict(left)
+        if right is not None:
+            joined.update(right)
+        return joined
+    return (left, right)
+
+class join(base.RawFilter):
+    """Joins the chunks with the chunks of other (a Producer or an iterable)
+    having the same key, left_key(chunk) == right_key(other_chunk), giving
+    combine(chunk, other_chunk) for every matching pair. Keys are keys of the
+    chunks or functions of them, right_key defaults to left_key.
+    By default, dicts are combined into a new dict with the items of both
+    (other_chunk's items winning), anything else into a tuple (chunk, other_chunk).
+    If how is 'left', chunks without any match are passed on as well, combined
+    with None.
+    other is read into a hash index when the pipe is entered, so it should be
+    the smaller side. If merge is True, both sides have to be sorted by key
+    instead, and other is read along with the chunks, keeping only the
+    chunks of other with the current key in memory."""
+    def __init__(self, other, left_key, right_key=None, how='inner', merge=False, combine=_join_rows):
+        base.RawFilter.__init__(self)
+        if how not in ('inner', 'left'):
+            raise ValueError('how has to be "inner" or "left"')
+        if not isinstance(other, base.Producer):
+            other = base.IteratorProducer(other)
+        self._other = other
+        self._left_key = _key_function(left_key)
+        self._right_key = _key_function(left_key if right_key is None else right_key)
+        self._left_join = how == 'left'
+        self._merge = merge
+        self._combine = combine
+        self._output = collections.deque()
+
+    def __enter__(self):
+        self._other = self._other.__enter__()
+        if self._merge:
+            self._right = self._other_chunks()
+            self._ahead = next(self._right, _NOTHING)
+            self._run_key = _NOTHING
+            self._run = []
+        else:
+            right_key = self._right_key
+            self._index = {}
+            for chunk in self._other_chunks():
+                self._index.setdefault(right_key(chunk), []).append(chunk)
+        return self
+
+    def __exit__(self, type_=None, value=None, traceback=None):
+        self._other.__exit__()
+
+    def _other_chunks(self):
+        while True:
+            try:
+                chunks = self._other.next_batch()
+            except StopIteration:
+                return
+            yield from chunks
+
+    def _merge_matches(self, key):
+        if self._run_key is not _NOTHING:
+            if key == self._run_key:
+                return self._run
+            if key < self._run_key:
+                raise ValueError('join: input is not sorted: %r after %r' % (key, self._run_key))
+        right_key = self._right_key
+        ahead = self._ahead
+        while ahead is not _NOTHING and right_key(ahead) < key:
+            ahead = next(self._right, _NOTHING)
+        run = []
+        while ahead is not _NOTHING and right_key(ahead) == key:
+            run.append(ahead)
+            ahead = next(self._right, _NOTHING)
+        self._ahead = ahead
+        self._run_key = key
+        self._run = run
+        return run
+
+    def _join(self, chunks, output):
+        left_key = self._left_key
+        combine = self._combine
+        for chunk in chunks:
+            key = left_key(chunk)
+            if self._merge:
+                matches = self._merge_matches(key)
+            else:
+                matches = self._index.get(key, ())
+            if matches:
+                for match in matches:
+                    output.append(combine(chunk, match))
+            elif self._left_join:
+                output.append(combine(chunk, None))
+
+    def send(self, chunk):
+        self._join((chunk,), self._output)
+
+    def send_batch(self, chunks):
+        self._join(chunks, self._output)
+
+    def __next__(self):
+        if self._output:
+            return self._output.popleft()
+        if self._last:
+            raise StopIteration
+        raise base.NeedData
+
+    def next_batch(self):
+        if self._output:
+            output = list(self._output)
+            self._output.clear()
+            return output
+        if self._last:
+            raise StopIteration
+        raise base.NeedData
+
+    def __str__(self):
+        return 'join(%s)' % str(self._other)
+
 class running_sum(base.Filter):
     def __init__(self):
         base.Filter.__init__(self)
         self._value = 0
 
-    def __next__(self):
-        self._value += self._chunk
+    def _process_chunk(self, chunk):
+        self._value += chunk
         return self._value
 
     def __str__(self):
@@ -328,9 +1171,9 @@ class running_average(base.Filter):
         self._average = 0.0
         self._num = 0
 
-    def __next__(self):
+    def _process_chunk(self, chunk):
         self._num += 1
-        self._average += (self._chunk - self._average) / self._num
+        self._average += (chunk - self._average) / self._num
         return self._average
 
 class apply(base.Filter):
@@ -339,20 +1182,65 @@ class apply(base.Filter):
         base.Filter.__init__(self)
         self._function = function
     
-    def __next__(self):
-        return self._function(self._chunk)
+    def _process_chunk(self, chunk):
+        return self._function(chunk)
+
+    def _process_batch(self, chunks):
+        return list(map(self._function, chunks))
 
     def __str__(self):
         return 'apply(%s)' % str(self._function)
 
+class parallel_apply(base.RawFilter):
+    """Applies the given function to every element piped to it, like apply,
+    but in a pool of workers processes (or threads, if threads is True).
+    At most window chunks are in flight (default: twice the number of workers),
+    the output keeps the order of the input. Exceptions raised by function
+    are propagated. For processes, function and chunks have to be picklable."""
+    def __init__(self, function, workers=None, window=None, threads=False):
+        base.RawFilter.__init__(self)
+        self._function = function
+        self._workers = workers or os.cpu_count() or 1
+        self._window = window or 2 * self._workers
+        self._threads = threads
+
+    def __enter__(self):
+        if self._threads:
+            self._executor = concurrent.futures.ThreadPoolExecutor(self._workers)
+        else:
+            self._executor = concurrent.futures.ProcessPoolExecutor(self._workers)
+        self._futures = collections.deque()
+        return self
+
+    def __exit__(self, type_=None, value=None, traceback=None):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+    def send(self, chunk):
+        self._futures.append(self._executor.submit(self._function, chunk))
+
+    def __next__(self):
+        futures = self._futures
+        if futures and (self._last or len(futures) >= self._window or futures[0].done()):
+            return futures.popleft().result()
+        if self._last:
+            raise StopIteration
+        raise base.NeedData
+
+    def __str__(self):
+        return 'parallel_apply(%s)' % str(self._function)
+
 class to_formatted_string(base.Filter):
     """Apply "format_string % x" to every input x."""
     def __init__(self, format_string):
         base.Filter.__init__(self)
         self._format = format_string
 
-    def __next__(self):
-        return self._format % self._chunk
+    def _process_chunk(self, chunk):
+        return self._format % chunk
+
+    def _process_batch(self, chunks):
+        format_string = self._format
+        return [format_string % chunk for chunk in chunks]
 
     def __str__(self):
         return 'to_formatted_string(%s)' % self._format
@@ -365,8 +1253,12 @@ class to_passwd_line(base.Filter):
 
     template = '%(name)s:%(password)s:%(uid)d:%(gid)d:%(gecos)s:%(home)s:%(shell)s'
 
-    def __next__(self):
-        return self.template % self._chunk
+    def _process_chunk(self, chunk):
+        return self.template % chunk
+
+    def _process_batch(self, chunks):
+        template = self.template
+        return [template % chunk for chunk in chunks]
 
     def __str__(self):
         return 'passwd()'
@@ -376,8 +1268,9 @@ class to_passwd_line_with_quota(to_passwd_line):
     quota is not None"""
     quota_template = to_passwd_line.template + ':userdb_quota_rule=*:bytes=%(quota)dM'
 
-    def __next__(self):
-        chunk = self._chunk
+    _process_batch = base.Filter._process_batch
+
+    def _process_chunk(self, chunk):
         if chunk['quota'] is None:
             return self.template % chunk
         else:
@@ -397,11 +1290,10 @@ class to_shadow_line(base.Filter):
 
     template = '%(name)s:%(password)s:%(lastchange)s:%(minage)s:%(maxage)s:%(warning_period)s:%(inact_period)s:%(expire_date)s:%(reserved)s'
 
-    def __next__(self):
-        chunk = self._chunk
+    def _process_chunk(self, chunk):
         for i in ('lastchange', 'minage', 'maxage', 'warning_period', 'inact_period', 'expire_date', 'reserved'):
-            chunk.setdefault(i, '')
-            if chunk[i] == -1:
+            if chunk.get(i, -1) == -1:
+                chunk = base.writable(chunk)
                 chunk[i] = ''
         return self.template % chunk
 
@@ -416,8 +1308,8 @@ class to_group_line(base.Filter):
 
     template = '%(group_name)s:%(group_password)s:%(gid)d:%(_member_list_str)s'
 
-    def __next__(self):
-        chunk = self._chunk
+    def _process_chunk(self, chunk):
+        chunk = base.writable(chunk)
         chunk['_member_list_str'] = ','.join(chunk['member_list'])
         return self.template % chunk
 
@@ -432,8 +1324,8 @@ class to_gshadow_line(base.Filter):
 
     template = '%(group_name)s:%(group_password)s:%(_administrator_list_str)s:%(_member_list_str)s'
 
-    def __next__(self):
-        chunk = self._chunk
+    def _process_chunk(self, chunk):
+        chunk = base.writable(chunk)
         chunk['_administrator_list_str'] = ','.join(chunk['administrator_list'])
         chunk['_member_list_str'] = ','.join(chunk['member_list'])
         return self.template % chunk
@@ -456,9 +1348,7 @@ MDomain "{domain}"
 </VirtualHost>
 """
 
-    def __next__(self):
-        chunk = self._chunk
-
+    def _process_chunk(self, chunk):
         res = ""
 
         if chunk['https']:
@@ -483,8 +1373,7 @@ class FromValue(base.Filter):
         self._newkey = newkey
         self._value = value
 
-    def __next__(self):
-        chunk = self._chunk
+    def _process_chunk(self, chunk):
         if type(self._value) in (str,):
             value = self._value % chunk
         else:
@@ -498,8 +1387,7 @@ class FromKey(base.Filter):
         self._newkey = newkey
         self._oldkey = oldkey
 
-    def __next__(self):
-        chunk = self._chunk
+    def _process_chunk(self, chunk):
         return self._set(chunk, self._newkey, chunk[self._oldkey])
 
 class FromFunction(base.Filter):
@@ -509,12 +1397,12 @@ class FromFunction(base.Filter):
         self._newkey = newkey
         self._function = function
 
-    def __next__(self):
-        chunk = self._chunk
+    def _process_chunk(self, chunk):
         return self._set(chunk, self._newkey, self._function(chunk))
 
 class Override(object):
     def _set(self, chunk, newkey, newval):
+        chunk = base.writable(chunk)
         chunk[newkey] = newval
         return chunk
 
@@ -522,12 +1410,15 @@ class Add(object):
     def _set(self, chunk, newkey, newval):
         if newkey in chunk:
             raise KeyError('Key exists already: %s' % newkey)
+        chunk = base.writable(chunk)
         chunk[newkey] = newval
         return chunk
 
 class Default(object):
     def _set(self, chunk, newkey, newval):
-        chunk.setdefault(newkey, newval)
+        if newkey not in chunk:
+            chunk = base.writable(chunk)
+            chunk[newkey] = newval
         return chunk
 
 class add_from_key(Add, FromKey):
@@ -588,10 +1479,10 @@ class replace_from_key(base.Filter):
         self._oldvalue = oldvalue
         self._oldkey = oldkey
 
-    def __next__(self):
-        chunk = self._chunk
+    def _process_chunk(self, chunk):
         try:
             if chunk[self._key] == format_if_string(self._oldvalue, chunk):
+                chunk = base.writable(chunk)
                 chunk[self._key] = chunk[self._oldkey]
         except KeyError:
             pass
@@ -604,10 +1495,10 @@ class replace_from_value(base.Filter):
         self._oldvalue = oldvalue
         self._newvalue = newvalue
 
-    def __next__(self):
-        chunk = self._chunk
+    def _process_chunk(self, chunk):
         try:
             if chunk[self._key] == format_if_string(self._oldvalue, chunk):
+                chunk = base.writable(chunk)
                 chunk[self._key] = format_if_string(self._newvalue, chunk)
         except KeyError:
             pass
@@ -620,10 +1511,10 @@ class replace_from_function(base.Filter):
         self._oldvalue = oldvalue
         self._function = function
 
-    def __next__(self):
-        chunk = self._chunk
+    def _process_chunk(self, chunk):
         try:
             if chunk[self._key] == format_if_string(self._oldvalue):
+                chunk = base.writable(chunk)
                 chunk[self._key] = self._function(chunk)
         except KeyError:
             pass
@@ -634,8 +1525,7 @@ class to_dict(base.Filter):
         base.Filter.__init__(self)
         self._keys = keys
 
-    def __next__(self):
-        chunk = self._chunk
+    def _process_chunk(self, chunk):
         if self._keys is None:
             return dict(chunk)
         else:
@@ -650,15 +1540,17 @@ class to_dict(base.Filter):
             return 'to_dict(%s)' % (str(self._keys))
 
 class to_string(base.Filter):
-    def __next__(self):
-        return str(self._chunk)
+    def _process_chunk(self, chunk):
+        return str(chunk)
+
+    def _process_batch(self, chunks):
+        return list(map(str, chunks))
 
     def __str__(self):
         return 'to_str()'
 
 class traverse(base.Filter):
-    def __next__(self):
-        chunk = self._chunk
+    def _process_chunk(self, chunk):
         try:
             if type(chunk) in (str,):
                 return chunk
@@ -679,8 +1571,7 @@ class log(base.Filter):
         self._loglevel = loglevel
         self._msg = msg
 
-    def __next__(self):
-        chunk = self._chunk
+    def _process_chunk(self, chunk):
         logger.log(self._loglevel, ' :'.join((self._msg, str(chunk))))
         return chunk
 
@@ -36,12 +36,20 @@ __license__ = """
 
 import subprocess
 import shlex
+import os
+import collections
+import heapq
 
 from . import base
 
 class sh(base.Producer):
-    """Produce from a shell command"""
-    def __init__(self, args, error_on_ret = False, **kwargs):
+    """Produce from a shell command, one chunk for each line of its output.
+    Lines are given as bytes, or as strings decoded with encoding if given.
+    If block_size is given, the output is read in blocks of block_size bytes,
+    which are split into lines in bulk. This is much faster for commands
+    giving lots of output, and next_batch() gives all lines of a block at once.
+    """
+    def __init__(self, args, error_on_ret = False, encoding=None, block_size=None, **kwargs):
         base.Producer.__init__(self)
         if type(args) in (str,):
             args = shlex.split(args)
@@ -53,20 +61,59 @@ class sh(base.Producer):
         if error_on_ret:
             self._cmd = args[0]
         self._leftover = None
+        self._encoding = encoding
+        self._block_size = block_size
 
     def __enter__(self):
         self._subprocess = subprocess.Popen(self._args, 
                                             stdout=subprocess.PIPE, 
                                             **self._kwargs)
+        if self._block_size is not None:
+            self._lines = collections.deque()
+            self._eof = False
+            self._splitter = base.LineSplitter(self._encoding)
         return self
+
+    def _read_block(self):
+        """Read the next block of output into self._lines,
+        raises StopIteration at the end of output."""
+        if self._eof:
+            raise StopIteration
+        block = os.read(self._subprocess.stdout.fileno(), self._block_size)
+        if block:
+            self._lines.extend(self._splitter.feed(block))
+        else:
+            self._eof = True
+            self._lines.extend(self._splitter.finish())
     
     def __next__(self):
+        if self._block_size is not None:
+            while not self._lines:
+                self._read_block()
+            return self._lines.popleft()
+
         # Read anything the process yields
         line_ = self._subprocess.stdout.readline()
-        if line_ == '':
+        if not line_:
             raise StopIteration
 
-        return line_.splitlines()[0]
+        # only strip the line ending, as LineSplitter does
+        if line_.endswith(b'\r\n'):
+            line_ = line_[:-2]
+        elif line_.endswith(b'\n'):
+            line_ = line_[:-1]
+        if self._encoding is not None:
+            return line_.decode(self._encoding)
+        return line_
+
+    def next_batch(self, size=None):
+        if self._block_size is None:
+            return base.Producer.next_batch(self, size)
+        while not self._lines:
+            self._read_block()
+        lines = list(self._lines)
+        self._lines.clear()
+        return lines
 
     def __exit__(self, type_=None, value=None, traceback=None):
         self._subprocess.wait()
@@ -88,3 +135,57 @@ class echo(base.Producer):
         raise StopIteration
 
         
+
+class merge_sorted(base.Producer):
+    """Merges Producers (or iterables) which are already sorted by key (and
+    reverse, like for sorted) into one sorted stream, lazily and with one
+    batch of chunks per input in memory. Equal chunks are taken from earlier
+    inputs first.
+    If verify is True, a ValueError is raised if an input turns out not to
+    be sorted."""
+    def __init__(self, *producers, key=None, reverse=False, verify=False):
+        base.Producer.__init__(self)
+        self._producers = [producer if isinstance(producer, base.Producer)
+                           else base.IteratorProducer(producer)
+                           for producer in producers]
+        self._key = key
+        self._reverse = reverse
+        self._verify = verify
+
+    def __enter__(self):
+        self._producers = [producer.__enter__() for producer in self._producers]
+        inputs = [self._chunks(producer) for producer in self._producers]
+        if self._verify:
+            inputs = [self._verified(input_, i) for i, input_ in enumerate(inputs)]
+        self._merged = heapq.merge(*inputs, key=self._key, reverse=self._reverse)
+        return self
+
+    def __exit__(self, type_=None, value=None, traceback=None):
+        for producer in self._producers:
+            producer.__exit__()
+
+    def _chunks(self, producer):
+        while True:
+            try:
+                chunks = producer.next_batch()
+            except StopIteration:
+                return
+            yield from chunks
+
+    def _verified(self, input_, index):
+        key = self._key
+        first = True
+        for chunk in input_:
+            current = chunk if key is None else key(chunk)
+            if not first and (previous < current if self._reverse else current < previous):
+                raise ValueError('Input %d of merge_sorted is not sorted: %r after %r' % (
+                                 index, current, previous))
+            previous = current
+            first = False
+            yield chunk
+
+    def __next__(self):
+        return next(self._merged)
+
+    def __str__(self):
+        return 'merge_sorted(%s)' % ', '.join([str(producer) for producer in self._producers])
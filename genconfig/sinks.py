@@ -101,6 +101,9 @@ class count(base.Sink):
     def send(self, chunk):
         self._num += 1
 
+    def send_batch(self, chunks):
+        self._num += len(chunks)
+
     def result(self):
         return self._num
 
@@ -144,6 +147,9 @@ class do(base.Sink):
     def send(self, chunk):
         pass
 
+    def send_batch(self, chunks):
+        pass
+
 class append_to_list(base.SinkNeedsAll):
     """Return all piped in elements in a list, appends them to a given list"""
     def __init__(self, list_ = None):
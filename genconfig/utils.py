@@ -57,6 +57,13 @@ import crypt
 from collections import namedtuple as _namedtuple
 import datetime
 import pickle
+import operator
+import struct
+import concurrent.futures
+import collections
+import collections.abc
+import contextlib
+import threading
 
 from . import base
 from . import filters
@@ -69,63 +76,360 @@ logger.addHandler(handler)
 
 ## Pipe objects
 
-#class from_db_procedure(base.Producer, mysql.cursors.DictCursor):
-#    """An automatically closing, generating cursor to be used on stored
-#    procedures.
-#
-#    Usage:
-#    
-#    with from_db_procedure(conn, 'backend_shell_accounts', ('eimer',)) as db:
-#        for row in db:
-#            #do something
-#
-#    or simply as a producer in a pipe:
-#    from_db_procedure(conn, 'backend_shell_accounts', ('eimer',)) | concat()
-#    """
-#    def __init__(self, connection, procedure, arguments=[]):
-#        mysql.cursors.DictCursor.__init__(self, connection)
-#        base.Producer.__init__(self)
-#        self._procedure = procedure
-#        self._arguments = arguments
-#
-#    def __enter__(self):
-#        self.callproc(self._procedure, self._arguments)
-#        return self
-#
-#    def next(self):
-#        row = self.fetchone()
-#        if row is None:
-#            raise StopIteration
-#        return row
-#
-#    def __exit__(self, type_=None, value=None, traceback=None):
-#        self.close()
-#
-#class from_db_query(base.Producer, mysql.cursors.DictCursor):
-#    """An automatically closing, generating cursor to execute arbitrary SQL commands.
-#    Usage like from_db_procedure."""
-#    def __init__(self, connection, query, args=None):
-#        mysql.cursors.DictCursor.__init__(self, connection)
-#        base.Producer.__init__(self)
-#        self._query = query
-#        self._args = args
-#        self._conn = connection
-#    
-#    def __enter__(self):
-#        self.execute(self._query, self._args)
-#        if self._conn.show_warnings():
-#            raise Exception('MySQLdb is stupid and suppresses this error: %s' % 
-#                            str(self._conn.show_warnings()))
-#        return self
-#
-#    def next(self):
-#        row = self.fetchone()
-#        if row is None:
-#            raise StopIteration
-#        return row
-#
-#    def __exit__(self, type_=None, value=None, traceback=None):
-#        self.close()
+class ConnectionPool(object):
+    """A pool of at most max_size DB-API 2 connections created by calling
+    connect(), to be shared by DB producers, sinks and pending.
+    Pass the pool instead of a connection to them, they check out a
+    connection for as long as they need it. Idle connections are checked with
+    check_query before being handed out again and replaced if broken.
+    Pools are closed by tear_down, or when used as a context manager:
+
+    with ConnectionPool(lambda: MySQLdb.connect(...)) as pool:
+        from_db_query(pool, 'SELECT * FROM accounts') | concat()
+    """
+    def __init__(self, connect, max_size=4, check_query='SELECT 1', timeout=None):
+        self._connect = connect
+        self._max_size = max_size
+        self._check_query = check_query
+        self._timeout = timeout
+        self._idle = collections.deque()
+        self._size = 0
+        self._closed = False
+        self._condition = threading.Condition()
+        _pools.append(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type_=None, value=None, traceback=None):
+        self.close()
+
+    def _healthy(self, conn):
+        if self._check_query is None:
+            return True
+        try:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(self._check_query)
+                cursor.fetchall()
+            finally:
+                cursor.close()
+        except Exception as error:
+            logger.warning('Dropping broken database connection: %s' % error)
+            return False
+        return True
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._condition:
+            self._size -= 1
+            self._condition.notify()
+
+    def checkout(self):
+        """Get a connection, waiting for one to be returned if max_size
+        connections are in use. Raises TimeoutError after timeout seconds."""
+        while True:
+            with self._condition:
+                if self._closed:
+                    raise ValueError('Connection pool is closed')
+                if not self._idle and self._size >= self._max_size:
+                    if not self._condition.wait_for(
+                            lambda: self._idle or self._size < self._max_size or self._closed,
+                            self._timeout):
+                        raise TimeoutError('No database connection available')
+                    continue
+                if self._idle:
+                    conn = self._idle.pop()
+                else:
+                    self._size += 1
+                    conn = None
+            if conn is None:
+                try:
+                    return self._connect()
+                except:
+                    with self._condition:
+                        self._size -= 1
+                        self._condition.notify()
+                    raise
+            if self._healthy(conn):
+                return conn
+            self._discard(conn)
+
+    def checkin(self, conn):
+        """Return a connection to the pool, rolling back uncommitted changes."""
+        try:
+            conn.rollback()
+        except Exception:
+            self._discard(conn)
+            return
+        with self._condition:
+            if not self._closed:
+                self._idle.append(conn)
+                self._condition.notify()
+                return
+        self._discard(conn)
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Context manager checking out a connection and returning it."""
+        conn = self.checkout()
+        try:
+            yield conn
+        finally:
+            self.checkin(conn)
+
+    def close(self):
+        """Close all idle connections, connections in use are closed when
+        they are returned."""
+        with self._condition:
+            self._closed = True
+            idle = list(self._idle)
+            self._idle.clear()
+            self._condition.notify_all()
+        for conn in idle:
+            self._discard(conn)
+
+# all pools, closed by tear_down
+_pools = []
+
+def close_pools():
+    """Close all ConnectionPools."""
+    while _pools:
+        _pools.pop().close()
+
+def _checkout(connection):
+    # connection can be a connection or a ConnectionPool
+    if isinstance(connection, ConnectionPool):
+        return connection.checkout()
+    return connection
+
+def _checkin(connection, conn):
+    if isinstance(connection, ConnectionPool):
+        connection.checkin(conn)
+
+class from_db_query(base.Producer):
+    """An automatically closing, generating cursor to execute arbitrary SQL
+    commands on any DB-API 2 connection.
+    Rows are fetched batch_size at a time with fetchmany, so the result is
+    never loaded completely (pass a cursor_factory creating a server-side cursor,
+    e.g. lambda conn: conn.cursor(MySQLdb.cursors.SSCursor), to keep the
+    driver from loading it either). If dict_rows is True, rows are given as
+    dicts mapping column names to values.
+
+    Usage:
+
+    with from_db_query(conn, 'SELECT * FROM accounts WHERE host = ?', ('eimer',)) as db:
+        for row in db:
+            #do something
+
+    or simply as a producer in a pipe:
+    from_db_query(conn, 'SELECT * FROM accounts') | concat()
+    connection can also be a ConnectionPool, a connection is checked out
+    from it until __exit__.
+    """
+    def __init__(self, connection, query, args=None, batch_size=None, dict_rows=False, cursor_factory=None):
+        base.Producer.__init__(self)
+        self._conn = connection
+        self._query = query
+        self._args = args
+        self._batch_size = batch_size or base.BATCH_SIZE
+        self._dict_rows = dict_rows
+        self._cursor_factory = cursor_factory
+        self._cursor = None
+        self._rows = collections.deque()
+
+    def _execute(self, cursor):
+        if self._args is None:
+            cursor.execute(self._query)
+        else:
+            cursor.execute(self._query, self._args)
+
+    def __enter__(self):
+        self._checked_out = _checkout(self._conn)
+        try:
+            if self._cursor_factory is None:
+                self._cursor = self._checked_out.cursor()
+            else:
+                self._cursor = self._cursor_factory(self._checked_out)
+            self._execute(self._cursor)
+            _check_warnings(self._checked_out)
+        except:
+            # __exit__ isn't called if __enter__ fails
+            if self._cursor is not None:
+                self._cursor.close()
+                self._cursor = None
+            _checkin(self._conn, self._checked_out)
+            raise
+        if self._dict_rows and self._cursor.description is not None:
+            self._columns = [column[0] for column in self._cursor.description]
+        return self
+
+    def __exit__(self, type_=None, value=None, traceback=None):
+        if self._cursor is not None:
+            self._cursor.close()
+            self._cursor = None
+            _checkin(self._conn, self._checked_out)
+
+    def next_batch(self, size=None):
+        if self._rows:
+            output = list(self._rows)
+            self._rows.clear()
+            return output
+        if self._cursor.description is None:
+            # statement without a result set
+            raise StopIteration
+        rows = self._cursor.fetchmany(size or self._batch_size)
+        if not rows:
+            raise StopIteration
+        if self._dict_rows:
+            columns = self._columns
+            rows = [row if isinstance(row, dict) else dict(zip(columns, row))
+                    for row in rows]
+        return rows
+
+    def __next__(self):
+        if not self._rows:
+            self._rows.extend(self.next_batch())
+        return self._rows.popleft()
+
+    def __str__(self):
+        return 'from_db_query(%s)' % self._query
+
+class from_db_procedure(from_db_query):
+    """An automatically closing, generating cursor to be used on stored
+    procedures. Usage like from_db_query, but the driver has to support
+    callproc (sqlite3 doesn't), and rows are given as dicts by default."""
+    def __init__(self, connection, procedure, arguments=(), batch_size=None, dict_rows=True, cursor_factory=None):
+        from_db_query.__init__(self, connection, procedure, arguments, batch_size,
+                               dict_rows, cursor_factory)
+
+    def _execute(self, cursor):
+        cursor.callproc(self._query, self._args)
+
+    def __str__(self):
+        return 'from_db_procedure(%s)' % self._query
+
+def _paramstyle(conn):
+    # paramstyle is defined by the driver module, not the connection
+    module = sys.modules.get(type(conn).__module__.split('.')[0])
+    return getattr(module, 'paramstyle', 'qmark')
+
+class to_db(base.Sink):
+    """Write chunks to a database, batch_size rows at a time with executemany,
+    each batch in a transaction of its own (rolled back on errors).
+    table_or_sql is either a table name, then an INSERT statement for columns
+    (or all columns of the table) is built using the paramstyle of the driver,
+    or an SQL statement, which is given the chunks as parameters unchanged.
+    For a table, chunks can be sequences or dicts (mapping column names to
+    values, columns default to the keys of the first chunk).
+    connection can also be a ConnectionPool. The result is the number of rows
+    written."""
+    def __init__(self, connection, table_or_sql, columns=None, batch_size=None):
+        base.Sink.__init__(self)
+        self._connection = connection
+        self._conn = None
+        if len(table_or_sql.split()) > 1:
+            self._sql = table_or_sql
+            self._table = None
+        else:
+            self._sql = None
+            self._table = table_or_sql
+        self._columns = columns
+        self._batch_size = batch_size or base.BATCH_SIZE
+        self._batch = []
+        self._rows = 0
+
+    def _prepare(self, chunk):
+        self._conn = _checkout(self._connection)
+        if self._sql is not None:
+            return
+        if self._columns is None and isinstance(chunk, collections.abc.Mapping):
+            self._columns = list(chunk.keys())
+        if self._columns is None:
+            names = ['c%d' % i for i in range(len(chunk))]
+        else:
+            names = list(self._columns)
+        style = _paramstyle(self._conn)
+        self._named = style in ('named', 'pyformat')
+        placeholders = {'qmark': lambda i, name: '?',
+                        'numeric': lambda i, name: ':%d' % (i + 1),
+                        'named': lambda i, name: ':%s' % name,
+                        'format': lambda i, name: '%s',
+                        'pyformat': lambda i, name: '%%(%s)s' % name}[style]
+        values = ', '.join([placeholders(i, name) for i, name in enumerate(names)])
+        if self._columns is None:
+            self._sql = 'INSERT INTO %s VALUES (%s)' % (self._table, values)
+        else:
+            self._sql = 'INSERT INTO %s (%s) VALUES (%s)' % (self._table,
+                                                         ', '.join(names), values)
+        self._names = names
+
+    def _row(self, chunk):
+        if isinstance(chunk, collections.abc.Mapping):
+            if self._named:
+                return chunk
+            return tuple([chunk[name] for name in self._names])
+        if self._named:
+            return dict(zip(self._names, chunk))
+        return chunk
+
+    def _flush(self):
+        batch = self._batch
+        self._batch = []
+        if self._table is not None:
+            batch = [self._row(chunk) for chunk in batch]
+        try:
+            cursor = self._conn.cursor()
+            try:
+                cursor.executemany(self._sql, batch)
+                _check_warnings(self._conn)
+            finally:
+                cursor.close()
+            self._conn.commit()
+        except:
+            self._conn.rollback()
+            _checkin(self._connection, self._conn)
+            self._conn = None
+            raise
+        self._rows += len(batch)
+
+    def send(self, chunk):
+        if self._conn is None:
+            self._prepare(chunk)
+        self._batch.append(chunk)
+        if len(self._batch) >= self._batch_size:
+            self._flush()
+
+    def send_batch(self, chunks):
+        if chunks and self._conn is None:
+            self._prepare(chunks[0])
+        self._batch.extend(chunks)
+        while len(self._batch) >= self._batch_size:
+            rest = self._batch[self._batch_size:]
+            del self._batch[self._batch_size:]
+            self._flush()
+            self._batch = rest
+
+    def result(self):
+        if self._conn is not None:
+            if self._batch:
+                self._flush()
+            _checkin(self._connection, self._conn)
+            self._conn = None
+        return self._rows
+
+    def __repr__(self):
+        return 'to_db(%s)' % (self._sql or self._table)
+
+def _check_warnings(conn):
+    # Only MySQLdb connections know show_warnings
+    show_warnings = getattr(conn, 'show_warnings', None)
+    if show_warnings is not None and show_warnings():
+        raise Exception('MySQLdb is stupid and suppresses this error: %s' % 
+                        str(show_warnings()))
 
 class inject_system_passwd(base.Filter):
     """Injects system users into the pipe stream."""
@@ -264,7 +568,7 @@ class makedirs(base.Sink):
         os.chown(dirname, pwd.getpwnam(owner).pw_uid, grp.getgrnam(group).gr_gid)
         os.chmod(dirname, permissions)
         if selinux_context is not None:
-            chcon(chunk['home'], self._selinux_context)
+            chcon(dirname, selinux_context)
 
 class chown(base.Sink):
     """chown chunk['filepath'] to chunk['owner'] and chunk['group']"""
@@ -306,16 +610,109 @@ class make_home_dirs(base.Sink):
         if self._skel is not None:
             copytree_with_ids(chunk['home'], self._skel, chunk['uid'], chunk['gid'])
 
+def _cdb_hash(key):
+    """The cdb hash function of bytes key"""
+    h = 5381
+    for c in key:
+        h = (((h << 5) + h) ^ c) & 0xffffffff
+    return h
+
+class to_cdb_map(base.Sink):
+    """Write a constant database (cdb) map filename.cdb from the piped in chunks,
+    like postmap cdb:filename does from a text file, but without the text file.
+    key(chunk) and value(chunk) give the key and value strings for each chunk,
+    by default chunks are expected to be (key, value) pairs.
+    Like postmap, keys are lowercased (unless fold_case is False), duplicate
+    keys are ignored with a warning and keys and values are stored without
+    a terminating null byte (unless null_terminated is True).
+    The map is written securely, permissions (and optionally selinux contexts)
+    are copied from an existing map or else from filename if it exists.
+    The result is a standard cdb file, so postfix and any other cdb reader
+    find the same entries as in postmap's map, but the file is not
+    guaranteed to be byte-for-byte identical to the one postmap writes.
+    """
+    def __init__(self, filename, key=operator.itemgetter(0), value=operator.itemgetter(1),
+                 fold_case=True, null_terminated=False, selinux=False):
+        base.Sink.__init__(self)
+        self._key = key
+        self._value = value
+        self._fold_case = fold_case
+        self._null = b'\0' if null_terminated else b''
+        self._target = filename + '.cdb'
+        transaction_ = base.current_transaction()
+        if transaction_ is not None:
+            transaction_.track(self._target + '.new')
+        self._fd = open(self._target + '.new', 'wb')
+        for reference in (self._target, filename):
+            if os.path.isfile(reference):
+                base.permissions_from_reference(self._fd.fileno(), reference, selinux)
+                break
+        # records start after the header of 256 (position, length) pairs
+        self._fd.seek(2048)
+        self._pos = 2048
+        self._tables = [[] for _ in range(256)]
+        self._seen = set()
+
+    def send(self, chunk):
+        key = self._key(chunk)
+        if self._fold_case:
+            key = key.lower()
+        key = key.encode('utf-8') + self._null
+        if key in self._seen:
+            logger.warning('%s: duplicate entry: "%s"', self._target, key.decode('utf-8'))
+            return
+        self._seen.add(key)
+        value = self._value(chunk).encode('utf-8') + self._null
+        hash_ = _cdb_hash(key)
+        self._tables[hash_ & 255].append((hash_, self._pos))
+        self._fd.write(struct.pack('<LL', len(key), len(value)) + key + value)
+        self._pos += 8 + len(key) + len(value)
+
+    def result(self):
+        header = []
+        for table in self._tables:
+            length = 2 * len(table)
+            slots = [(0, 0)] * length
+            for hash_, pos in table:
+                i = (hash_ >> 8) % length
+                while slots[i][1]:
+                    i = (i + 1) % length
+                slots[i] = (hash_, pos)
+            header.append(struct.pack('<LL', self._pos, length))
+            self._fd.write(b''.join([struct.pack('<LL', *slot) for slot in slots]))
+            self._pos += 8 * length
+        if self._pos > 0xffffffff:
+            self._fd.close()
+            os.unlink(self._target + '.new')
+            raise ValueError('cdb map %s would exceed 4GB' % self._target)
+        self._fd.seek(0)
+        self._fd.write(b''.join(header))
+        self._fd.flush()
+        transaction_ = base.current_transaction()
+        if transaction_ is not None:
+            self._fd.close()
+            transaction_.add(self._target + '.new', self._target)
+        else:
+            os.fsync(self._fd.fileno())
+            self._fd.close()
+            os.rename(self._target + '.new', self._target)
+        return True
+
 
 def pending(conn, query):
-    cursor = conn.cursor()
-    cursor.execute("SELECT %s()" % query)
-    if conn.show_warnings():
-        raise Exception('MySQLdb is stupid and suppresses this error: %s' % 
-                        str(conn.show_warnings()))
-    
-    result = cursor.fetchall()[0][0]
-    cursor.close()
+    """Call the SQL function query and return its result. conn can be a
+    connection or a ConnectionPool."""
+    connection = _checkout(conn)
+    try:
+        cursor = connection.cursor()
+        try:
+            cursor.execute("SELECT %s()" % query)
+            _check_warnings(connection)
+            result = cursor.fetchall()[0][0]
+        finally:
+            cursor.close()
+    finally:
+        _checkin(conn, connection)
     return result
 
 ## Time-Keeping functions
@@ -579,28 +976,90 @@ def get_domain_from_emailaddr(address):
     return address.rpartition('@')[2]
 
 def chcon(filename, context):
-    subprocess.check_call(('/usr/bin/chcon', context, filename))
+    """Set the selinux context of filename (or a file descriptor).
+    Panics (raises OSError) if it fails."""
+    os.setxattr(filename, base.SELINUX_XATTR, context.encode() + b'\0')
+
+MAP_EXTENSIONS = {'hash': '.db', 'cdb': '.cdb'}
+
+def _run_postmap(filename, maptype, selinux):
+    """Run postmap and copy permissions, raises on failure."""
+    subprocess.check_call(('postmap', ':'.join((maptype, filename))))
+    logger.debug('Successfully mapped %s', ':'.join((maptype, filename)))
+    base.permissions_from_reference(filename + MAP_EXTENSIONS[maptype],
+                                         filename,
+                                         selinux=selinux)
 
 def postmap(filename, maptype='cdb', selinux=False):
     """Run postmap on filename, (with the specified maptype)
     and give the generated map the same permissions as
     the file itself.
     Will always copy selinux contexts."""
-    extension = {'hash': '.db', 'cdb': '.cdb'}
-
-    if maptype not in extension:
+    if maptype not in MAP_EXTENSIONS:
         raise NotImplementedError
 
     try:
-        subprocess.check_call(('postmap', ':'.join((maptype, filename))))
-        logger.debug('Successfully mapped %s', ':'.join((maptype, filename)))
+        _run_postmap(filename, maptype, selinux)
     except subprocess.CalledProcessError:
         logger.error('Could not update map %s:%s', maptype, filename)
         sys.exit(errno.EIO)
 
-    base.permissions_from_reference(filename + extension[maptype],
-                                         filename,
-                                         selinux=selinux)
+MAP_REBUILT = 'rebuilt'
+MAP_UNCHANGED = 'unchanged'
+MAP_FAILED = 'failed'
+MAP_DIGESTS = '/var/lib/genconfig/map_digests'
+
+def update_maps(maps, maptype='cdb', selinux=False, jobs=4, digestfile=MAP_DIGESTS):
+    """Run postmap on all given maps whose source file or maptype changed
+    since the last successful run (or whose map file is missing), running
+    up to jobs postmap processes at a time.
+    maps is an iterable of filenames or (filename, maptype) pairs, maptype
+    is used for plain filenames. The digests of the sources are kept
+    in digestfile.
+    Returns a dict mapping each filename to MAP_REBUILT, MAP_UNCHANGED or
+    MAP_FAILED. Failures are logged, and retried on the next run."""
+    try:
+        with open(digestfile, 'rb') as fd:
+            digests = pickle.load(fd)
+    except IOError:
+        logger.warning('No map digest database found, rebuilding all maps.')
+        digests = {}
+
+    status = {}
+    todo = []
+    for map_ in maps:
+        if type(map_) in (str,):
+            map_ = (map_, maptype)
+        filename, type_ = map_
+        if type_ not in MAP_EXTENSIONS:
+            raise NotImplementedError
+        state = (type_, base.file_digest(filename))
+        if (digests.get(filename) == state
+            and os.path.isfile(filename + MAP_EXTENSIONS[type_])):
+            status[filename] = MAP_UNCHANGED
+        else:
+            todo.append((filename, type_, state))
+
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        futures = [(filename, type_, state,
+                    executor.submit(_run_postmap, filename, type_, selinux))
+                   for filename, type_, state in todo]
+        for filename, type_, state, future in futures:
+            try:
+                future.result()
+            except Exception as err:
+                logger.error('Could not update map %s:%s: %s', type_, filename, err)
+                digests.pop(filename, None)
+                status[filename] = MAP_FAILED
+            else:
+                digests[filename] = state
+                status[filename] = MAP_REBUILT
+
+    if todo:
+        with open(digestfile + '.new', 'wb') as fd:
+            pickle.dump(digests, fd)
+        os.rename(digestfile + '.new', digestfile)
+    return status
 
 LOCKFILE = "/var/lock/genconfig"
 
@@ -655,6 +1114,7 @@ def setup(loglevel=20):
             
 
 def tear_down():
+    close_pools()
     release_lock()
     release_reported_lock()
     logging.shutdown()
@@ -0,0 +1,105 @@
+"""Tests for the to_cdb_map sink in genconfig.utils."""
+
+import os
+import shutil
+import struct
+import subprocess
+import tempfile
+import unittest
+
+from genconfig import base, utils
+
+
+def cdb_get(path, key):
+    """Look up key in the cdb file path, following the cdb specification."""
+    with open(path, 'rb') as fd:
+        data = fd.read()
+    hash_ = utils._cdb_hash(key)
+    position, length = struct.unpack_from('<LL', data, (hash_ & 255) * 8)
+    for i in range(length):
+        slot = position + 8 * (((hash_ >> 8) + i) % length)
+        slot_hash, record = struct.unpack_from('<LL', data, slot)
+        if record == 0:
+            return None
+        if slot_hash == hash_:
+            key_length, value_length = struct.unpack_from('<LL', data, record)
+            if data[record+8:record+8+key_length] == key:
+                return data[record+8+key_length:record+8+key_length+value_length]
+    return None
+
+def cdb_records(path):
+    """All (key, value) records of the cdb file path, in file order."""
+    with open(path, 'rb') as fd:
+        data = fd.read()
+    # the records end where the first hash table starts
+    end = min(struct.unpack_from('<512L', data)[::2])
+    records = []
+    position = 2048
+    while position < end:
+        key_length, value_length = struct.unpack_from('<LL', data, position)
+        key = data[position+8:position+8+key_length]
+        value = data[position+8+key_length:position+8+key_length+value_length]
+        records.append((key, value))
+        position += 8 + key_length + value_length
+    return records
+
+def postmap_has_cdb():
+    if shutil.which('postmap') is None or shutil.which('postconf') is None:
+        return False
+    types = subprocess.run(['postconf', '-m'], stdout=subprocess.PIPE,
+                           universal_newlines=True).stdout.split()
+    return 'cdb' in types
+
+
+class ToCdbMapTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'aliases')
+        # more than 254 keys in one bucket, and keys spread over all others
+        bucket = []
+        i = 0
+        while len(bucket) < 600:
+            key = 'alias%d@example.org' % i
+            if utils._cdb_hash(key.encode('utf-8')) & 255 == 0:
+                bucket.append(key)
+            i += 1
+        self.entries = [(key, 'user%d' % n) for n, key in enumerate(bucket)]
+        self.entries += [('other%d@example.org' % n, 'user%d' % n) for n in range(3000)]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_lookup(self):
+        entries = self.entries + [(self.entries[0][0].upper(), 'duplicate')]
+        self.assertTrue(entries | utils.to_cdb_map(self.filename))
+        path = self.filename + '.cdb'
+        for key, value in self.entries:
+            self.assertEqual(cdb_get(path, key.encode('utf-8')), value.encode('utf-8'))
+        self.assertIsNone(cdb_get(path, b'missing@example.org'))
+        self.assertEqual(len(cdb_records(path)), len(self.entries))
+
+    def test_failing_pipe_in_transaction(self):
+        with self.assertRaises(AttributeError):
+            with base.transaction():
+                self.entries[:10] + [('broken@example.org', None)] \
+                    | utils.to_cdb_map(self.filename)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    @unittest.skipUnless(postmap_has_cdb(), 'postmap with cdb support is not available')
+    def test_same_entries_as_postmap(self):
+        self.entries | utils.to_cdb_map(self.filename)
+        os.rename(self.filename + '.cdb', self.filename + '.ours.cdb')
+        with open(self.filename, 'w') as fd:
+            for key, value in self.entries:
+                fd.write('%s %s\n' % (key, value))
+        subprocess.check_call(['postmap', 'cdb:' + self.filename])
+        ours = self.filename + '.ours.cdb'
+        self.assertEqual(cdb_records(ours), cdb_records(self.filename + '.cdb'))
+        for key, value in self.entries[::50]:
+            found = subprocess.run(['postmap', '-q', key, 'cdb:' + self.filename + '.ours'],
+                                   stdout=subprocess.PIPE, universal_newlines=True)
+            self.assertEqual(found.stdout.strip(), value)
+
+
+if __name__ == '__main__':
+    unittest.main()
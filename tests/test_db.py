@@ -0,0 +1,66 @@
+"""Tests for the database helpers in genconfig.utils, run against sqlite3."""
+
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from genconfig import filters, sinks, utils
+
+
+class ProcedureCursor(sqlite3.Cursor):
+    """sqlite3 has no stored procedures, callproc runs a query instead."""
+    def callproc(self, procedure, arguments):
+        return self.execute('SELECT name, uid FROM accounts WHERE uid < ?', arguments)
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        conn = sqlite3.connect(self.filename)
+        conn.execute('CREATE TABLE accounts (name, uid)')
+        conn.executemany('INSERT INTO accounts VALUES (?, ?)',
+                         [('user%d' % i, 1000 + i) for i in range(10)])
+        conn.commit()
+        conn.close()
+        self.pool = utils.ConnectionPool(lambda: sqlite3.connect(self.filename),
+                                         max_size=2, timeout=1)
+
+    def tearDown(self):
+        self.pool.close()
+        os.unlink(self.filename)
+
+    def test_query(self):
+        rows = utils.from_db_query(self.pool, 'SELECT name FROM accounts WHERE uid < ?',
+                                   (1002,), dict_rows=True) | sinks.append_to_list()
+        self.assertEqual(rows, [{'name': 'user0'}, {'name': 'user1'}])
+
+    def test_procedure_gives_dicts(self):
+        rows = utils.from_db_procedure(self.pool, 'accounts', (1001,),
+                                       cursor_factory=lambda conn: conn.cursor(ProcedureCursor)) \
+               | sinks.append_to_list()
+        self.assertEqual(rows, [{'name': 'user0', 'uid': 1000}])
+
+    def test_failing_query_returns_connection(self):
+        for i in range(3):
+            with self.assertRaises(sqlite3.OperationalError):
+                utils.from_db_query(self.pool, 'SELECT * FROM missing') | sinks.count()
+        self.assertEqual(utils.from_db_query(self.pool, 'SELECT * FROM accounts')
+                         | sinks.count(), 10)
+        self.assertEqual(range(3) | filters.apply(lambda i: ('new%d' % i, i))
+                         | utils.to_db(self.pool, 'accounts'), 3)
+
+    def test_to_db_rolls_back_failing_batch(self):
+        conn = sqlite3.connect(self.filename)
+        conn.execute('CREATE TABLE names (name PRIMARY KEY)')
+        conn.commit()
+        with self.assertRaises(sqlite3.IntegrityError):
+            [('a',), ('b',), ('c',), ('a',)] | utils.to_db(conn, 'names', batch_size=2)
+        self.assertEqual(conn.execute('SELECT name FROM names').fetchall(),
+                         [('a',), ('b',)])
+        conn.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
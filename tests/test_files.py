@@ -0,0 +1,108 @@
+"""Tests for the file writing sinks in genconfig.base."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from genconfig import base
+
+
+class WriteSecurelyToFileTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.target = os.path.join(self.directory, 'target')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_only_if_changed(self):
+        digests = {}
+        self.assertTrue(['a'] | base.write_securely_to_file(self.target, only_if_changed=True,
+                                                            digests=digests))
+        self.assertFalse(['a'] | base.write_securely_to_file(self.target, only_if_changed=True,
+                                                             digests=digests))
+        self.assertFalse(os.path.exists(self.target + '.new'))
+
+    def test_deleted_target_is_recreated(self):
+        digests = {}
+        ['a'] | base.write_securely_to_file(self.target, only_if_changed=True, digests=digests)
+        os.unlink(self.target)
+        self.assertTrue(['a'] | base.write_securely_to_file(self.target, only_if_changed=True,
+                                                            digests=digests))
+        with open(self.target) as fd:
+            self.assertEqual(fd.read(), 'a\n')
+
+
+class WriteSecurelyToFileTemplateTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.template = os.path.join(self.directory, '%(name)s')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_same_target_last_wins(self):
+        rows = [{'name': 'same' if i % 2 else 'file%d' % (i % 5), 'content': str(i)}
+                for i in range(50)]
+        for workers in (None, 4):
+            summary = rows | base.write_securely_to_file_template('content', self.template,
+                                                                  workers=workers)
+            self.assertEqual(summary.failed, [])
+            self.assertEqual(len(summary.written), len(set(summary.written)))
+            with open(os.path.join(self.directory, 'same')) as fd:
+                self.assertEqual(fd.read(), '49\n')
+            self.assertEqual(sorted(os.listdir(self.directory)),
+                             ['file%d' % i for i in range(5)] + ['same'])
+
+    def test_superseded_write_of_unchanged_content(self):
+        rows = [{'name': 'same', 'content': 'a'}]
+        rows | base.write_securely_to_file_template('content', self.template, workers=2)
+        rows = [{'name': 'same', 'content': 'b'}, {'name': 'same', 'content': 'a'}]
+        summary = rows | base.write_securely_to_file_template('content', self.template,
+                                                              workers=2)
+        self.assertEqual(summary.written, [])
+        self.assertEqual(os.listdir(self.directory), ['same'])
+        with open(os.path.join(self.directory, 'same')) as fd:
+            self.assertEqual(fd.read(), 'a\n')
+
+
+class TransactionTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.target = os.path.join(self.directory, 'target')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_failing_pipe_is_removed(self):
+        with self.assertRaises(TypeError):
+            with base.transaction():
+                base.IteratorProducer(['a']) > self.target
+                base.IteratorProducer(['x', 1]) > os.path.join(self.directory, 'bad')
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_only_complete_files_are_renamed(self):
+        with base.transaction():
+            base.IteratorProducer(['a']) > self.target
+            with self.assertRaises(TypeError):
+                base.IteratorProducer(['x', 1]) > os.path.join(self.directory, 'bad')
+        self.assertFalse(os.path.exists(os.path.join(self.directory, 'bad')))
+        with open(self.target) as fd:
+            self.assertEqual(fd.read(), 'a\n')
+
+    def test_same_target_last_wins(self):
+        rows = [{'name': 'target', 'content': 'a'}, {'name': 'target', 'content': 'b'}]
+        template = os.path.join(self.directory, '%(name)s')
+        with base.transaction():
+            base.IteratorProducer(['a']) > self.target
+            base.IteratorProducer(['b']) > self.target
+        with base.transaction():
+            rows | base.write_securely_to_file_template('content', template)
+        self.assertEqual(os.listdir(self.directory), ['target'])
+        with open(self.target) as fd:
+            self.assertEqual(fd.read(), 'b\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+"""Tests for filters in genconfig.filters."""
+
+import collections
+import unittest
+
+from genconfig import base, filters, sinks
+
+
+def big(chunk):
+    return 'x' * 100000
+
+def increment(chunk):
+    return chunk + 1
+
+def odd(chunk):
+    return chunk % 2
+
+
+class UniqueTest(unittest.TestCase):
+    def test_unhashable(self):
+        chunks = [{'a': [1]}, collections.OrderedDict(a=[1]), {1}, frozenset({1}),
+                  (1, [2]), [1, [2]], (1, [2]), [1, [2]]]
+        for approximate in (False, True):
+            out = chunks | filters.unique(approximate=approximate) | sinks.append_to_list()
+            self.assertEqual(out, [{'a': [1]}, {1}, (1, [2]), [1, [2]]])
+
+    def test_key(self):
+        chunks = [{'name': 'a', 'n': 1}, {'name': 'b', 'n': 2}, {'name': 'a', 'n': 3}]
+        out = chunks | filters.unique(key=lambda chunk: chunk['name']) | sinks.append_to_list()
+        self.assertEqual(out, chunks[:2])
+
+
+class MultiplyChunkTest(unittest.TestCase):
+    def test_parallel_output(self):
+        data = list(range(2000))
+        expected = data | filters.multiply_chunk(filters.apply(increment), filters.where(odd),
+                                                 filters.take(7)) | sinks.append_to_list()
+        for parallel in ('thread', 'process'):
+            out = data | filters.multiply_chunk(filters.apply(increment), filters.where(odd),
+                                                filters.take(7), parallel=parallel) \
+                  | sinks.append_to_list()
+            self.assertEqual(out, expected)
+
+    def test_thread_copy_on_write(self):
+        rows = [{'name': 'user%d' % i, 'uid': i} for i in range(100)]
+        branches = lambda: (filters.add_from_value('shell', '/bin/sh'),
+                            filters.override_from_function('uid', lambda row: row['uid'] + 1))
+        expected = rows | filters.multiply_chunk(*branches()) | sinks.append_to_list()
+        out = rows | filters.multiply_chunk(*branches(), parallel='thread') | sinks.append_to_list()
+        self.assertEqual(out, expected)
+        self.assertEqual(rows[0], {'name': 'user0', 'uid': 0})
+
+    def test_early_close(self):
+        # workers are blocked on full outboxes when the pipe is closed
+        for parallel in ('thread', 'process'):
+            out = base.IteratorProducer(range(1000)) \
+                  | filters.multiply_chunk(filters.apply(big), filters.apply(big),
+                                           parallel=parallel) \
+                  | filters.take(2) | sinks.count()
+            self.assertEqual(out, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,294 @@
+"""Tests for combining Filters and driving them in genconfig.base."""
+
+import unittest
+
+from genconfig import base, filters, sinks
+
+
+def increment(chunk):
+    return chunk + 1
+
+def odd(chunk):
+    return chunk % 2
+
+
+class Nested(base.RawFilter):
+    """Two Filters combined by nesting them, like CombinedFilter used to, to
+    check the flat CombinedFilter against."""
+    def __init__(self, source, target):
+        base.RawFilter.__init__(self)
+        self._source = source
+        self._target = target
+        self._source_exhausted = False
+
+    def send(self, chunk):
+        self._source.send(chunk)
+
+    def last(self):
+        self._source.last()
+
+    def __next__(self):
+        try:
+            return next(self._target)
+        except base.NeedData:
+            pass
+        while True:
+            if not self._source_exhausted:
+                try:
+                    self._target.send(next(self._source))
+                except StopIteration:
+                    self._target.last()
+                    self._source_exhausted = True
+            try:
+                return next(self._target)
+            except base.NeedData:
+                pass
+
+    def __enter__(self):
+        self._source = self._source.__enter__()
+        self._target = self._target.__enter__()
+        return self
+
+    def __exit__(self, type_=None, value=None, traceback=None):
+        self._source.__exit__()
+        self._target.__exit__()
+
+def nested(stages):
+    combined = stages[0]
+    for stage in stages[1:]:
+        combined = Nested(combined, stage)
+    return combined
+
+
+class Repeat(base.RawFilter):
+    """Passes on every chunk n times."""
+    def __init__(self, n):
+        base.RawFilter.__init__(self)
+        self._n = n
+        self._queue = []
+
+    def send(self, chunk):
+        self._queue = [chunk] * self._n
+
+    def __next__(self):
+        if self._queue:
+            return self._queue.pop()
+        if self._last:
+            raise StopIteration
+        raise base.NeedData
+
+class Emit(base.RawFilter):
+    """Passes on the given chunks and stops, without any input."""
+    def __init__(self, chunks):
+        base.RawFilter.__init__(self)
+        self._chunks = list(chunks)
+
+    def __next__(self):
+        if not self._chunks:
+            raise StopIteration
+        return self._chunks.pop(0)
+
+
+MODES = ('chunk', 'batch', 'mixed')
+
+def drive(filter_, chunks, mode='chunk', size=3):
+    """Drive filter_ by hand, sending chunks one at a time ('chunk'), in
+    batches of size ('batch'), or one at a time but alternating between
+    next() and next_batch() to get output ('mixed').
+    Returns the output and the number of chunks sent."""
+    chunks = list(chunks)
+    output = []
+    sent = 0
+    calls = 0
+    last = False
+    filter_ = filter_.__enter__()
+    while True:
+        calls += 1
+        try:
+            if mode == 'batch' or (mode == 'mixed' and calls % 2):
+                output.extend(filter_.next_batch())
+            else:
+                output.append(next(filter_))
+        except base.NeedData:
+            if sent < len(chunks):
+                if mode == 'batch':
+                    filter_.send_batch(chunks[sent:sent+size])
+                    sent = min(sent + size, len(chunks))
+                else:
+                    filter_.send(chunks[sent])
+                    sent += 1
+            elif last:
+                raise AssertionError('NeedData after last()')
+            else:
+                filter_.last()
+                last = True
+        except StopIteration:
+            break
+    filter_.__exit__()
+    return output, sent
+
+
+class CombinedFilterTest(unittest.TestCase):
+    def assertSameAsNested(self, stages, chunks):
+        """Check the flat combination of stages() against the nested one in all
+        modes, returns the output and number of chunks sent in chunk mode."""
+        for mode in MODES:
+            flat = drive(base.CombinedFilter(*stages()), chunks, mode)
+            self.assertEqual(flat, drive(nested(stages()), chunks, mode), mode)
+        return drive(base.CombinedFilter(*stages()), chunks)
+
+    def test_flattened(self):
+        pipe = filters.apply(increment) | filters.where(odd) | filters.take(3) \
+               | filters.apply(increment)
+        self.assertEqual(len(pipe._stages), 4)
+        self.assertEqual(pipe._stages[0]._function, increment)
+
+    def test_take_in_the_middle(self):
+        stages = lambda: (filters.apply(increment), filters.take(3), filters.apply(increment))
+        self.assertEqual(self.assertSameAsNested(stages, range(10)), ([2, 3, 4], 4))
+        stages = lambda: (filters.take(2), filters.where(odd), filters.take(5))
+        self.assertEqual(self.assertSameAsNested(stages, range(10)), ([1], 3))
+
+    def test_needs_all_after_last(self):
+        stages = lambda: (filters.where(odd), filters.sort(reverse=True), filters.take(3),
+                          filters.reverse(), filters.apply(increment))
+        self.assertEqual(self.assertSameAsNested(stages, range(20)), ([16, 18, 20], 20))
+        stages = lambda: (filters.tail(4), filters.sort(), filters.tail(2))
+        self.assertEqual(self.assertSameAsNested(stages, [5, 3, 9, 1, 7, 2]), ([7, 9], 6))
+
+    def test_multi_output_in_the_middle(self):
+        stages = lambda: (filters.apply(increment), Repeat(3), filters.take(7),
+                          filters.apply(increment))
+        self.assertEqual(self.assertSameAsNested(stages, range(10)),
+                         ([2, 2, 2, 3, 3, 3, 4], 3))
+        stages = lambda: (filters.take(3),
+                          filters.multiply_chunk(filters.apply(increment), filters.where(odd)),
+                          filters.apply(increment))
+        self.assertEqual(self.assertSameAsNested(stages, range(10)),
+                         ([2, 3, 2, 4], 4))
+
+    def test_mixed_next_and_next_batch(self):
+        stages = lambda: (filters.where(odd), Repeat(2), filters.sort(), filters.tail(5),
+                          filters.apply(increment), filters.take(4))
+        out, sent = self.assertSameAsNested(stages, range(15))
+        self.assertEqual(drive(base.CombinedFilter(*stages()), range(15), 'mixed'),
+                         (out, sent))
+        self.assertEqual(out, [10, 12, 12, 14])
+        # take_while stops within a batch, and must not be fed any more
+        stages = lambda: (filters.multiply_chunk(filters.apply(abs), filters.apply(increment)),
+                          filters.take_while(lambda chunk: chunk != 3),
+                          filters.apply(increment))
+        self.assertEqual(self.assertSameAsNested(stages, [0, 2, 1, 0]), ([1, 2, 3], 2))
+
+    def test_stops_without_input(self):
+        stages = lambda: (Emit(['a', 'b']), filters.apply(str.upper), Repeat(2))
+        self.assertEqual(self.assertSameAsNested(stages, ['x']), (['A', 'A', 'B', 'B'], 0))
+
+
+class FilteredSinkTest(unittest.TestCase):
+    def test_premature_close(self):
+        for stages in (lambda: (Emit(['a', 'b']), filters.apply(str.upper)),
+                       lambda: (base.RawFilter(), filters.apply(str.upper))):
+            expected = ['x', 'y'] | (nested(stages()) | sinks.append_to_list())
+            out = ['x', 'y'] | (base.CombinedFilter(*stages()) | sinks.append_to_list())
+            self.assertEqual(out, expected)
+        self.assertEqual(out, [])
+        self.assertEqual(['x'] | (Emit(['a', 'b']) | filters.apply(str.upper)
+                                  | sinks.append_to_list()), ['A', 'B'])
+
+    def test_stops_early(self):
+        stages = lambda: (filters.apply(increment), filters.take(3), Repeat(2))
+        out = range(100) | (base.CombinedFilter(*stages()) | sinks.append_to_list())
+        self.assertEqual(out, range(100) | (nested(stages()) | sinks.append_to_list()))
+        self.assertEqual(out, [1, 1, 2, 2, 3, 3])
+
+
+def feed(sink, chunks, size=None):
+    """Feed chunks to sink one at a time, or in batches of size if given,
+    until it stops, and return its result."""
+    chunks = list(chunks)
+    try:
+        if size is None:
+            for chunk in chunks:
+                sink.send(chunk)
+        else:
+            for i in range(0, len(chunks), size):
+                sink.send_batch(chunks[i:i+size])
+    except StopIteration:
+        pass
+    return sink.result()
+
+
+class BatchProtocolTest(unittest.TestCase):
+    def assertSameInBatches(self, filter_, chunks):
+        """Check that filter_() gives the same output in batches of any size as
+        one chunk at a time, returns the output."""
+        expected, _ = drive(filter_(), chunks)
+        for size in (1, 3, base.BATCH_SIZE + 1):
+            self.assertEqual(drive(filter_(), chunks, 'batch', size)[0], expected, size)
+        self.assertEqual(drive(filter_(), chunks, 'mixed')[0], expected)
+        return expected
+
+    def test_filter(self):
+        for filter_ in (lambda: filters.apply(increment), lambda: filters.where(odd),
+                        lambda: filters.skip(4), lambda: filters.unique(key=odd),
+                        lambda: filters.take_while(lambda chunk: chunk < 7)):
+            self.assertSameInBatches(filter_, range(20))
+        self.assertEqual(self.assertSameInBatches(lambda: filters.skip(4), range(6)), [4, 5])
+
+    def test_raw_filter_fallback(self):
+        self.assertEqual(self.assertSameInBatches(lambda: filters.tail(3), range(20)),
+                         [17, 18, 19])
+        self.assertEqual(self.assertSameInBatches(lambda: filters.take(4), range(20)),
+                         [0, 1, 2, 3])
+        self.assertEqual(self.assertSameInBatches(lambda: filters.take(0), range(20)), [])
+        for parallel in (None, 'thread'):
+            branches = lambda: filters.multiply_chunk(filters.apply(increment),
+                                                      filters.where(odd), filters.take(3),
+                                                      parallel=parallel)
+            self.assertEqual(self.assertSameInBatches(branches, range(5)),
+                             [1, 0, 2, 1, 1, 3, 2, 4, 3, 5])
+
+    def test_filter_needs_all(self):
+        chunks = [(i * 7919) % 3001 for i in range(2 * base.BATCH_SIZE + 5)]
+        self.assertEqual(self.assertSameInBatches(lambda: filters.sort(), chunks),
+                         sorted(chunks))
+        self.assertEqual(self.assertSameInBatches(lambda: filters.sort(run_size=100), chunks),
+                         sorted(chunks))
+        self.assertEqual(self.assertSameInBatches(lambda: filters.reverse(), range(10)),
+                         list(range(9, -1, -1)))
+        self.assertEqual(self.assertSameInBatches(lambda: filters.reverse(), []), [])
+
+    def test_filtered_producer(self):
+        chunks = [1, 2, 5, 3, 4, 1, 2]
+        pipe = lambda: base.IteratorProducer(chunks) | filters.take_while(lambda chunk: chunk != 3)
+        with pipe() as producer:
+            self.assertEqual(list(producer), [1, 2, 5])
+        for size in range(1, 8):
+            with pipe() as producer:
+                out = producer.next_batch(size)
+                # must not go on after take_while stopped within the batch
+                out.extend(producer)
+            self.assertEqual(out, [1, 2, 5], size)
+
+    def test_multi_sink(self):
+        sink = lambda: (filters.take(3) | sinks.append_to_list()) & sinks.count() \
+                       & (filters.where(odd) | filters.apply(increment) | sinks.append_to_list())
+        expected = feed(sink(), range(10))
+        self.assertEqual(expected, [[0, 1, 2], 10, [2, 4, 6, 8, 10]])
+        for size in (1, 3, 100):
+            self.assertEqual(feed(sink(), range(10), size), expected, size)
+        self.assertEqual(range(10) | sink(), expected)
+
+    def test_filtered_sink(self):
+        for sink in (lambda: filters.apply(increment) | filters.tail(2) | sinks.append_to_list(),
+                     lambda: filters.take(4) | filters.sort(reverse=True) | sinks.append_to_list(),
+                     lambda: filters.where(odd) | filters.take(2) | sinks.count()):
+            expected = feed(sink(), range(10))
+            for size in (1, 3, 100):
+                self.assertEqual(feed(sink(), range(10), size), expected, size)
+            self.assertEqual(range(10) | sink(), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
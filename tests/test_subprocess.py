@@ -0,0 +1,43 @@
+"""Tests for line splitting of subprocess output (sh, sh_filter, sh_filter_pool)."""
+
+import unittest
+
+from genconfig import base, filters, producers, sinks
+
+
+class LineSplitterTest(unittest.TestCase):
+    def test_splits_on_newline_only(self):
+        splitter = base.LineSplitter()
+        lines = splitter.feed(b'a\x0cb\rc\nd\x1c') + splitter.feed(b'e\r\nf') + splitter.finish()
+        self.assertEqual(lines, [b'a\x0cb\rc', b'd\x1ce', b'f'])
+
+    def test_decodes_across_blocks(self):
+        splitter = base.LineSplitter('utf-8')
+        data = 'ä ö\n\nü'.encode('utf-8')
+        lines = []
+        for i in range(len(data)):
+            lines.extend(splitter.feed(data[i:i+1]))
+        lines.extend(splitter.finish())
+        self.assertEqual(lines, ['ä ö', '', 'ü'])
+
+
+class SubprocessTest(unittest.TestCase):
+    def test_block_mode(self):
+        out = producers.sh(['printf', r'a\x0cb\rc\nd\r\n'], block_size=2) | sinks.append_to_list()
+        self.assertEqual(out, [b'a\x0cb\rc', b'd'])
+
+    def test_line_mode(self):
+        out = producers.sh(['printf', r'a\x0cb\rc\nd\x1ce\r\n\nf'], encoding='utf-8') \
+              | sinks.append_to_list()
+        self.assertEqual(out, ['a\x0cb\rc', 'd\x1ce', '', 'f'])
+        out = producers.sh(['printf', r'a\x0cb\n']) | sinks.append_to_list()
+        self.assertEqual(out, [b'a\x0cb'])
+
+    def test_sh_filter_pool_keeps_records(self):
+        chunks = ['a\x1cb', 'c', 'd\x85e', 'f\x0cg']
+        out = chunks | filters.sh_filter_pool('cat', processes=2) | sinks.append_to_list()
+        self.assertEqual(out, chunks)
+
+
+if __name__ == '__main__':
+    unittest.main()